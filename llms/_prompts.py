@@ -0,0 +1,13 @@
+import os
+import orjson
+from functools import lru_cache
+
+PROMPTS_PATH = os.path.join(os.path.dirname(__file__), "..", "prompts.json")
+
+@lru_cache(maxsize=1)
+def load_prompts():
+    """Reads prompts.json once; every LLM module shares the same parsed dict."""
+    with open(PROMPTS_PATH, "rb") as f:
+        return orjson.loads(f.read())
+
+PROMPTS = load_prompts()
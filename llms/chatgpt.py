@@ -1,62 +1,149 @@
 import os
 import logging
-import json
-from openai import OpenAI
-from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations
+import orjson
+import httpx
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI, DefaultHttpxClient, LengthFinishReasonError, NOT_GIVEN
+from pydantic import ValidationError
+from utils.llm_cache import cached
+from utils.retry import resilient
+from utils.concurrency import service_slot
+from utils.ratelimit import rate_limit
+from utils.helpers import split_into_batches, read_page_number, write_output
+from utils.micro_batcher import MicroBatcher
+from llms._prompts import PROMPTS
+from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations, CombinedPipelineOutput, EntitiesBatchOutput
 
-PROMPTS_PATH = os.path.join(os.path.dirname(__file__), "..", "prompts.json")
-with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
-    PROMPTS = json.load(f)
+# Upper bound on concurrent per-entity explanation requests
+EXPLAIN_MAX_WORKERS = int(os.getenv("EXPLAIN_MAX_WORKERS", 16))
+# Number of entities explained together in a single request
+EXPLAIN_WINDOW = int(os.getenv("EXPLAIN_WINDOW", 25))
+# Documents whose entities are extracted together in a single request (1 disables batching)
+ENTITY_BATCH_SIZE = int(os.getenv("ENTITY_BATCH_SIZE", 1))
+# Seconds a partial entity batch waits for more documents
+ENTITY_BATCH_WAIT = float(os.getenv("ENTITY_BATCH_WAIT", 2))
+# Upper bound on the text in one entity batch, in characters (~100k tokens)
+ENTITY_BATCH_MAX_CHARS = int(os.getenv("ENTITY_BATCH_MAX_CHARS", 400_000))
 
+# One entity batcher per (client, model)
+_entity_batchers = {}
+_entity_batchers_lock = threading.Lock()
+
+@lru_cache(maxsize=4)
 def get_client(api_key):
-    return OpenAI(api_key=api_key)
+    """Returns one shared client per API key so HTTP/2 connections are reused across files."""
+    return OpenAI(
+        api_key=api_key,
+        max_retries=5,
+        http_client=DefaultHttpxClient(http2=True, limits=httpx.Limits(max_connections=64)),
+    )
+
+@cached
+@resilient
+def complete(client, model_name, prompt_name, text, temperature=0.0, response_format=None):
+    """
+    Runs a chat completion with a prompt from prompts.json as the system message.
+    `response_format` is either a pydantic model, for schema-constrained structured output,
+    or an OpenAI response_format dict such as {"type": "json_object"}.
+    Retries come from `@resilient` alone; the SDK's own retries are turned off for this call.
+    """
+    messages = [
+        {"role": "system", "content": PROMPTS[prompt_name]},
+        {"role": "user", "content": text}
+    ]
+    rate_limit(__name__, model_name, PROMPTS[prompt_name], text)
+    client = client.with_options(max_retries=0)
+    with service_slot("llm"):
+        if isinstance(response_format, type):
+            response = client.beta.chat.completions.parse(
+                model=model_name, messages=messages, temperature=temperature, response_format=response_format
+            )
+        else:
+            response = client.chat.completions.create(
+                model=model_name, messages=messages, temperature=temperature, response_format=response_format or NOT_GIVEN
+            )
+    return (response.choices[0].message.content or "").strip()
 
 def correct_text(text, base_name, doc_output_dir, client, model_name, save=True) -> CorrectedText:                                                                                                                                                                                                                                    
     logging.info(f"Correcting OCR text for: {base_name}")
     
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[
-            {"role": "system", "content": PROMPTS["correct_text"]},
-            {"role": "user", "content": text}
-        ],
-        temperature=0.0
-    )
-    
-    corrected_text = response.choices[0].message.content.strip()
+    corrected_text = complete(client, model_name, "correct_text", text, temperature=0.0)
 
     if save:
         corrected_path = os.path.join(doc_output_dir, base_name + ".corrected.txt")
-        with open(corrected_path, "w", encoding="utf-8") as f:
-            f.write(corrected_text)
+        write_output(corrected_path, corrected_text)
         logging.info(f"Corrected text saved: {corrected_path}")
 
-    return CorrectedText(corrected_text=corrected_text)
+    return CorrectedText.model_construct(corrected_text=corrected_text)
+
+def extract_entities_batch(items, client, model_name):
+    """
+    Extracts entities from several documents with a single structured-output call.
+    Args:
+        items (list): (base_name, text) pairs.
+        client (OpenAI): OpenAI client.
+        model_name (str): OpenAI model to use.
+    Returns:
+        dict: Mapping of base_name to `EntitiesOutput`; documents missing from the reply are left out.
+            Each document's entities are cached as its own single-document request.
+    """
+    logging.info(f"[ChatGPT] Extracting entities for {len(items)} documents in one request")
+    text = "\n\n".join(f"--- DOC {i} ---\n{doc_text}" for i, (_, doc_text) in enumerate(items, start=1))
+    # Sent uncached: which documents share a batch varies from run to run
+    output = EntitiesBatchOutput.model_validate_json(complete.__wrapped__(
+        client, model_name, "extract_entities_batch", text, temperature=0, response_format=EntitiesBatchOutput
+    ))
+
+    by_id = {document.doc_id.strip(): document.entities for document in output.documents}
+    found = {}
+    for i, (base_name, doc_text) in enumerate(items, start=1):
+        if str(i) in by_id:
+            found[base_name] = by_id[str(i)]
+            complete.store(
+                found[base_name].model_dump_json(), client, model_name, "extract_entities", doc_text,
+                temperature=0, response_format=EntitiesOutput,
+            )
+    return found
+
+def get_entity_batcher(client, model_name):
+    """Returns the shared batcher that groups entity extraction requests from concurrent documents."""
+    with _entity_batchers_lock:
+        key = (id(client), model_name)
+        if key not in _entity_batchers:
+            def handle(items):
+                found = extract_entities_batch(items, client, model_name)
+                return [found.get(base_name) for base_name, _ in items]
+
+            _entity_batchers[key] = MicroBatcher(
+                handle, ENTITY_BATCH_SIZE, ENTITY_BATCH_WAIT,
+                max_size=ENTITY_BATCH_MAX_CHARS, size=lambda item: len(item[1]),
+            )
+        return _entity_batchers[key]
 
 def extract_entities(text, base_name, doc_output_dir, client, model_name) -> EntitiesOutput:
     logging.info(f"Extracting entities with ChatGPT for: {base_name}")
-    
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[
-            {"role": "system", "content": PROMPTS["extract_entities"]},
-            {"role": "user", "content": text}
-        ],
-        temperature=0.2
-    )
-
-    result = response.choices[0].message.content.strip()
 
-    try:
-        parsed = json.loads(result)
-    except json.JSONDecodeError:
-        parsed = {"People": [], "Productions": [], "Companies": [], "Theaters": [], "Dates": []}
+    entities = None
+    # Entities cached by an earlier run are read by the single-document request without waiting for a batch
+    if ENTITY_BATCH_SIZE > 1 and complete.lookup(
+        client, model_name, "extract_entities", text, temperature=0, response_format=EntitiesOutput
+    ) is None:
+        try:
+            entities = get_entity_batcher(client, model_name).submit((base_name, text)).result()
+        except Exception as e:
+            logging.warning(f"[ChatGPT] Batched entity extraction failed for {base_name}: {e}")
+        if entities is None:
+            logging.info(f"[ChatGPT] Extracting entities for {base_name} on its own")
 
-    entities = EntitiesOutput(**parsed)
+    if entities is None:
+        entities = complete.validated(
+            EntitiesOutput, client, model_name, "extract_entities", text, temperature=0, response_format=EntitiesOutput
+        )
 
     entity_path = os.path.join(doc_output_dir, base_name + ".entities.json")
-    with open(entity_path, "w", encoding="utf-8") as f:
-        f.write(entities.model_dump_json(indent=2))
+    write_output(entity_path, entities.model_dump_json(indent=2))
 
     logging.info(f"Entity extraction saved: {entity_path}")
     return entities
@@ -65,70 +152,118 @@ def explain_entities(entities, base_name, doc_output_dir, client, model_name) ->
     logging.info(f"[ChatGPT] Explaining entities for {base_name}")
     explanations = {"People": {}, "Productions": {}, "Companies": {}, "Theaters": {}}
 
-    for category in explanations.keys():
-        items = getattr(entities, category, [])
-        for item in items:
+    def explain_one(category, item):
+        explanation = complete(client, model_name, "explain_entities", f"Category: {category}\nEntity: {item}", temperature=0.2)
+        return category, item, explanation
 
-            response = client.chat.completions.create(
-                model=model_name, 
-                messages=[
-                    {"role": "system", "content": PROMPTS["explain_entities"]},
-                    {"role": "user", "content": f"Category: {category}\nEntity: {item}"}
-                ], temperature=0.2
+    def explain_window(window):
+        grouped = {}
+        for category, item in window:
+            grouped.setdefault(category, []).append(item)
+        payload = [{"category": category, "items": items} for category, items in grouped.items()]
+        request = orjson.dumps(payload).decode()
+        result = complete(
+            client, model_name, "explain_entities_batch", request,
+            temperature=0.2, response_format={"type": "json_object"},
+        )
+
+        try:
+            parsed = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            complete.invalidate(
+                client, model_name, "explain_entities_batch", request,
+                temperature=0.2, response_format={"type": "json_object"},
             )
+            parsed = {}
+
+        found, missing = [], []
+        for category, item in window:
+            section = parsed.get(category)
+            explanation = section.get(item) if isinstance(section, dict) else None
+            if isinstance(explanation, str) and explanation.strip():
+                found.append((category, item, explanation.strip()))
+            else:
+                missing.append((category, item))
+        return found, missing
 
-            explanation = response.choices[0].message.content.strip()
-            explanations[category][item] = explanation
+    pairs = [(category, item) for category in explanations for item in getattr(entities, category, [])]
+    missing = []
+    with ThreadPoolExecutor(max_workers=EXPLAIN_MAX_WORKERS) as executor:
+        for found, not_found in executor.map(explain_window, split_into_batches(pairs, EXPLAIN_WINDOW)):
+            for category, item, explanation in found:
+                explanations[category][item] = explanation
+            missing.extend(not_found)
 
-    entity_explanations = EntityExplanations(**explanations)
+        # Fall back to one request per entity for anything the batched replies missed
+        if missing:
+            logging.warning(f"[ChatGPT] Explaining {len(missing)} entities individually for {base_name}")
+            for category, item, explanation in executor.map(lambda pair: explain_one(*pair), missing):
+                explanations[category][item] = explanation
+
+    entity_explanations = EntityExplanations.model_validate(explanations)
 
     explain_path = os.path.join(doc_output_dir, base_name + ".entities_explained.json")
-    with open(explain_path, "w", encoding="utf-8") as f:
-        f.write(entity_explanations.model_dump_json(indent=2))
+    write_output(explain_path, entity_explanations.model_dump_json(indent=2))
 
     logging.info(f"[ChatGPT] Entity explanations saved: {explain_path}")
     return entity_explanations
 
-def extract_page_and_split_letters(corrected_text_path, client, model_name) -> CombinedOutput:
-    try:
+def extract_page_and_split_letters(corrected_text_path, client, model_name, text=None) -> CombinedOutput:
+    """
+    Reads the page number and splits the corrected text into letters.
+    `text` is the corrected text when the caller already holds it, so the file is not read back.
+    """
+    if text is None:
         with open(corrected_text_path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+            text = f.read()
 
-        if not lines:
-            return CombinedOutput(page_number=None, letters=[])
+    if not text:
+        return CombinedOutput(page_number=None, letters=[])
 
-        first_line = lines[0].strip()
-        text = "".join(lines)
+    page_number = read_page_number(text)
 
-        try:
-            page_number = int(first_line.strip())
-        except ValueError:
-            page_number = None
-
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": PROMPTS["split_letters"] + f"\nText:\n{text}"}],
-            temperature=0
-        )
+    try:
+        letters = complete.validated(
+            CombinedOutput, client, model_name, "split_letters", text, temperature=0, response_format=CombinedOutput
+        ).letters or [text]
+    except (ValidationError, LengthFinishReasonError) as e:
+        logging.warning(f"Could not parse letter split for {corrected_text_path}, keeping the text whole: {e}")
+        letters = [text]
 
-        result = response.choices[0].message.content.strip()
+    # The page number read from the first line takes precedence over the model's
+    combined = CombinedOutput.model_construct(page_number=page_number, letters=letters)
 
-        try:
-            letters = json.loads(result)
-            if not isinstance(letters, list):
-                letters = [text]
-        except json.JSONDecodeError:
-            logging.warning(f"Invalid JSON returned when splitting letters. Falling back to full text.")
-            letters = [text]
-
-        combined = CombinedOutput(page_number=page_number, letters=letters)
-
-        combined_path = corrected_text_path.replace(".corrected.txt", ".combined_output.json")
-        with open(combined_path, "w", encoding="utf-8") as f:
-            f.write(combined.model_dump_json(indent=2))
-
-        logging.info(f"Combined output saved: {combined_path}")
-        return combined
-    except Exception as e:
-        logging.error(f"Failed to extract page and split letters for {corrected_text_path}: {e}")
-        return CombinedOutput(page_number=None, letters=[])
\ No newline at end of file
+    combined_path = corrected_text_path.replace(".corrected.txt", ".combined_output.json")
+    write_output(combined_path, combined.model_dump_json(indent=2))
+
+    logging.info(f"Combined output saved: {combined_path}")
+    return combined
+
+def process_document(text, base_name, doc_output_dir, client, model_name):
+    """
+    Corrects the OCR text, extracts entities and splits letters with a single structured-output call.
+    Returns:
+        tuple: (CorrectedText, EntitiesOutput, CombinedOutput), each also saved to doc_output_dir.
+    """
+    logging.info(f"[ChatGPT] Processing {base_name} in a single call")
+    output = complete.validated(
+        CombinedPipelineOutput, client, model_name, "process_document", text, temperature=0, response_format=CombinedPipelineOutput
+    )
+
+    corrected_path = os.path.join(doc_output_dir, base_name + ".corrected.txt")
+    write_output(corrected_path, output.corrected_text)
+
+    entity_path = os.path.join(doc_output_dir, base_name + ".entities.json")
+    write_output(entity_path, output.entities.model_dump_json(indent=2))
+
+    # A page number on the first line takes precedence over the model's
+    page_number = read_page_number(output.corrected_text, default=output.page_number)
+    combined = CombinedOutput.model_construct(page_number=page_number, letters=output.letters or [output.corrected_text])
+
+    combined_path = os.path.join(doc_output_dir, base_name + ".combined_output.json")
+    write_output(combined_path, combined.model_dump_json(indent=2))
+
+    logging.info(f"[ChatGPT] Corrected text, entities and combined output saved for {base_name}")
+    return CorrectedText.model_construct(corrected_text=output.corrected_text), output.entities, combined
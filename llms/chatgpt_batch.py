@@ -0,0 +1,255 @@
+import os
+import logging
+import orjson
+import time
+from pydantic import ValidationError
+from llms._prompts import PROMPTS
+from llms.chatgpt import explain_entities
+from utils.helpers import read_page_number, write_output
+from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Structured output for batched entity extraction, matching the real-time request
+ENTITIES_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "EntitiesOutput",
+        "strict": True,
+        "schema": {**EntitiesOutput.model_json_schema(), "additionalProperties": False},
+    },
+}
+
+def build_request(custom_id, model_name, prompt_name, text, temperature, response_format=None):
+    """
+    Builds a single Batch API request line for a chat completion.
+    Args:
+        custom_id (str): Identifier used to map the result back, e.g. "<base_name>:correct".
+        model_name (str): OpenAI model to use.
+        prompt_name (str): Key of the system prompt in prompts.json.
+        text (str): User content for the request.
+        temperature (float): Sampling temperature.
+        response_format (dict | None): OpenAI response_format, e.g. a json_schema for structured output.
+    Returns:
+        dict: Request line for the batch input JSONL.
+    """
+    body = {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": PROMPTS[prompt_name]},
+            {"role": "user", "content": text}
+        ],
+        "temperature": temperature,
+    }
+    if response_format:
+        body["response_format"] = response_format
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }
+
+def submit_batch(requests, jsonl_path, client):
+    """
+    Writes the requests to a JSONL file, uploads it and starts a batch job.
+    Args:
+        requests (list): Request lines built by `build_request`.
+        jsonl_path (str): Path to write the batch input file to.
+        client (OpenAI): OpenAI client.
+    Returns:
+        str: Batch ID.
+    """
+    with open(jsonl_path, "wb") as f:
+        for request in requests:
+            f.write(orjson.dumps(request, option=orjson.OPT_APPEND_NEWLINE))
+
+    with open(jsonl_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window="24h",
+    )
+    logging.info(f"[Batch] Submitted {len(requests)} requests (BatchId: {batch.id})")
+    return batch.id
+
+def wait_for_batch(batch_id, client, initial_delay=15, max_delay=600):
+    """
+    Polls a batch job with exponential backoff until it reaches a terminal status.
+    Args:
+        batch_id (str): Batch ID.
+        client (OpenAI): OpenAI client.
+        initial_delay (int): First delay between polls in seconds.
+        max_delay (int): Upper bound on the delay between polls in seconds.
+    Returns:
+        Batch: The final batch object.
+    """
+    delay = initial_delay
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATUSES:
+            logging.info(f"[Batch] {batch_id} finished with status '{batch.status}'")
+            return batch
+        logging.info(f"[Batch] {batch_id} is '{batch.status}', checking again in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def download_results(batch, client):
+    """
+    Downloads the output of a finished batch job.
+    Args:
+        batch (Batch): Finished batch object.
+        client (OpenAI): OpenAI client.
+    Returns:
+        dict: Mapping of custom_id to the response message content.
+    """
+    results = {}
+    if not batch.output_file_id:
+        logging.error(f"[Batch] {batch.id} has no output file (status '{batch.status}')")
+        return results
+
+    # orjson parses the downloaded bytes directly, without decoding them to str first
+    for line in client.files.content(batch.output_file_id).content.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            logging.warning(f"[Batch] Request {record.get('custom_id')} failed: {record.get('error') or response.get('status_code')}")
+            continue
+        results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"].strip()
+
+    return results
+
+def run_batch(requests, jsonl_path, client):
+    """Submits the requests as one batch job, waits for it and returns its results."""
+    if not requests:
+        return {}
+    batch_id = submit_batch(requests, jsonl_path, client)
+    batch = wait_for_batch(batch_id, client)
+    return download_results(batch, client)
+
+def parse_letters(result, text):
+    """
+    Parses a letter-splitting reply into a list of letters.
+    Args:
+        result (str | None): Response content, a JSON list of letters.
+        text (str): Text that was split, used when the reply is missing or invalid.
+    Returns:
+        list: Letters, or `[text]` if none could be parsed.
+    """
+    try:
+        letters = orjson.loads(result or "")
+    except orjson.JSONDecodeError:
+        return [text]
+    if isinstance(letters, dict):
+        letters = letters.get("letters")
+    if not isinstance(letters, list) or not letters:
+        return [text]
+    return [str(letter) for letter in letters]
+
+def process_documents(documents, work_dir, client, model_name):
+    """
+    Runs LLM post-processing for OCR'd documents through the Batch API.
+    Correction is submitted as one batch job; entity extraction and letter
+    splitting, which both work on the corrected text, share a second one.
+    Entity explanations then run in real time on the results.
+    Args:
+        documents (dict): Mapping of base_name to the path of its `.raw.txt` file.
+        work_dir (str): Directory for the batch input JSONL files.
+        client (OpenAI): OpenAI client.
+        model_name (str): OpenAI model to use.
+    Returns:
+        dict: Mapping of base_name to its `CorrectedText`, `EntitiesOutput` and `CombinedOutput`,
+              each None for a step that failed and was not saved.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    texts = {}
+    for base_name, raw_path in documents.items():
+        with open(raw_path, "r", encoding="utf-8") as f:
+            texts[base_name] = f.read()
+
+    # --- Correct text ---
+    correct_requests = [
+        build_request(f"{base_name}:correct", model_name, "correct_text", text, 0.0)
+        for base_name, text in texts.items()
+    ]
+    corrected = run_batch(correct_requests, os.path.join(work_dir, "batch_correct.jsonl"), client)
+
+    results = {}
+    for base_name, raw_path in documents.items():
+        doc_output_dir = os.path.dirname(raw_path)
+        corrected_text = corrected.get(f"{base_name}:correct")
+        # Nothing is saved for a failed correction, so the next run retries the document
+        if corrected_text is None or (not corrected_text.strip() and texts[base_name].strip()):
+            logging.warning(f"[Batch] No correction returned for {base_name}")
+            results[base_name] = {"corrected": None}
+            continue
+
+        corrected_path = os.path.join(doc_output_dir, base_name + ".corrected.txt")
+        write_output(corrected_path, corrected_text)
+        logging.info(f"[Batch] Corrected text saved: {corrected_path}")
+
+        results[base_name] = {"corrected": CorrectedText.model_construct(corrected_text=corrected_text)}
+
+    # --- Extract entities + split into letters ---
+    followup_requests = []
+    for base_name, result in results.items():
+        # As in the real-time path, entities fall back to the OCR text; letters are only split from corrected text
+        text = result["corrected"].corrected_text if result["corrected"] else texts[base_name]
+        followup_requests.append(build_request(
+            f"{base_name}:entities", model_name, "extract_entities", text, 0.0, ENTITIES_RESPONSE_FORMAT
+        ))
+        if result["corrected"]:
+            followup_requests.append(build_request(f"{base_name}:split", model_name, "split_letters", text, 0.0))
+    followups = run_batch(followup_requests, os.path.join(work_dir, "batch_entities_split.jsonl"), client)
+
+    for base_name, raw_path in documents.items():
+        doc_output_dir = os.path.dirname(raw_path)
+        result = results[base_name]
+
+        entities = None
+        entities_result = followups.get(f"{base_name}:entities")
+        if entities_result is None:
+            logging.warning(f"[Batch] No entities returned for {base_name}")
+        else:
+            try:
+                entities = EntitiesOutput.model_validate_json(entities_result)
+            except ValidationError as e:
+                logging.warning(f"[Batch] Could not parse entities for {base_name}: {e}")
+        if entities is not None:
+            entity_path = os.path.join(doc_output_dir, base_name + ".entities.json")
+            write_output(entity_path, entities.model_dump_json(indent=2))
+            logging.info(f"[Batch] Entity extraction saved: {entity_path}")
+
+        # The combined output marks a document as done, so it is only written for a returned split
+        combined = None
+        split_result = followups.get(f"{base_name}:split")
+        if result["corrected"] and split_result is None:
+            logging.warning(f"[Batch] No letter split returned for {base_name}")
+        elif result["corrected"]:
+            corrected_text = result["corrected"].corrected_text
+            # A page number on the first line of the corrected text, as in the real-time path
+            combined = CombinedOutput(
+                page_number=read_page_number(corrected_text),
+                letters=parse_letters(split_result, corrected_text),
+            )
+            combined_path = os.path.join(doc_output_dir, base_name + ".combined_output.json")
+            write_output(combined_path, combined.model_dump_json(indent=2))
+            logging.info(f"[Batch] Combined output saved: {combined_path}")
+
+        result["entities"] = entities
+        result["combined"] = combined
+
+        # --- Real-time step ---
+        if entities is None:
+            continue
+        try:
+            explain_entities(entities, base_name, doc_output_dir, client, model_name)
+        except Exception as e:
+            logging.warning(f"[Batch] Entity explanation failed for {base_name}: {e}")
+
+    return results
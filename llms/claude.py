@@ -1,95 +1,206 @@
 import os
 import logging
-import json
-from anthropic import Anthropic
-from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations
-
-PROMPTS_PATH = os.path.join(os.path.dirname(__file__), "..", "prompts.json")
-with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
-    PROMPTS = json.load(f)
-
+import orjson
+import httpx
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from anthropic import Anthropic, DefaultHttpxClient
+from pydantic import ValidationError
+from utils.llm_cache import cached
+from utils.retry import resilient
+from utils.concurrency import service_slot
+from utils.ratelimit import rate_limit
+from utils.helpers import split_into_batches, read_page_number, write_output
+from llms._prompts import PROMPTS
+from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations, CombinedPipelineOutput
+
+# Upper bound on concurrent per-entity explanation requests
+EXPLAIN_MAX_WORKERS = int(os.getenv("EXPLAIN_MAX_WORKERS", 16))
+# Number of entities explained together in a single request
+EXPLAIN_WINDOW = int(os.getenv("EXPLAIN_WINDOW", 25))
+
+@lru_cache(maxsize=4)
 def get_client(api_key=None):
-    return Anthropic(api_key=api_key or os.getenv("ANTHROPIC_API_KEY"))
+    """Returns one shared client per API key so HTTP/2 connections are reused across files."""
+    return Anthropic(
+        api_key=api_key or os.getenv("ANTHROPIC_API_KEY"),
+        max_retries=5,
+        http_client=DefaultHttpxClient(http2=True, limits=httpx.Limits(max_connections=64)),
+    )
+
+def cached_system(prompt_name):
+    """
+    Builds a system block for a static prompt, marked for Anthropic prompt caching.
+    The cached prefix must precede the variable OCR text, which is sent as the user message.
+    """
+    return [{"type": "text", "text": PROMPTS[prompt_name], "cache_control": {"type": "ephemeral"}}]
+
+@cached
+@resilient
+def complete(client, model_name, prompt_name, text, max_tokens=4096, output_schema=None):
+    """
+    Runs a message request with a prompt from prompts.json as the cached system block.
+    With `output_schema` (a pydantic model) the reply is forced through a tool whose input
+    schema is the model's JSON schema, and the tool input is returned as JSON text.
+    Retries come from `@resilient` alone; the SDK's own retries are turned off for this call.
+    """
+    tool_kwargs = {}
+    if output_schema is not None:
+        tool_kwargs = {
+            "tools": [{
+                "name": "emit_output",
+                "description": f"Return the result as {output_schema.__name__}.",
+                "input_schema": output_schema.model_json_schema(),
+            }],
+            "tool_choice": {"type": "tool", "name": "emit_output"},
+        }
+
+    rate_limit(__name__, model_name, PROMPTS[prompt_name], text)
+    with service_slot("llm"):
+        resp = client.with_options(max_retries=0).messages.create(
+            model=model_name, max_tokens=max_tokens,
+            system=cached_system(prompt_name),
+            messages=[{"role": "user", "content": text}],
+            **tool_kwargs
+        )
+
+    if output_schema is not None:
+        tool_use = next(block for block in resp.content if block.type == "tool_use")
+        return orjson.dumps(tool_use.input).decode()
+    return resp.content[0].text.strip()
 
 def correct_text(text, base_name, output_dir, client, model_name) -> CorrectedText:
     logging.info(f"[Claude] Correcting OCR text for: {base_name}")
 
-    resp = client.messages.create(
-        model=model_name, max_tokens=4096,
-        messages=[{"role": "user", "content": PROMPTS["correct_text"] + f"\nText:\n{text}"}]
-    )
-
-    corrected_text = resp.content[0].text.strip()
+    corrected_text = complete(client, model_name, "correct_text", text)
     corrected_path = os.path.join(output_dir, base_name + ".corrected.txt")
-    with open(corrected_path, "w", encoding="utf-8") as f:
-        f.write(corrected_text)
+    write_output(corrected_path, corrected_text)
 
-    return CorrectedText(corrected_text=corrected_text)
+    return CorrectedText.model_construct(corrected_text=corrected_text)
 
-def explain_entities(entities, base_name, output_dir, client, model_name) -> EntityExplanations:
-    logging.info(f"[Claude] Explaining entities for {base_name}")
-    explanations = {"People": {}, "Productions": {}, "Companies": {}, "Theaters": {}}
+def extract_entities(text, base_name, output_dir, client, model_name) -> EntitiesOutput:
+    logging.info(f"[Claude] Extracting entities for: {base_name}")
 
-    for category in explanations.keys():
-        items = getattr(entities, category, [])
-        for item in items:
+    entities = complete.validated(EntitiesOutput, client, model_name, "extract_entities", text, output_schema=EntitiesOutput)
 
-            resp = client.messages.create(
-                model=model_name, max_tokens=4096,
-                messages=[
-                    {"role": "system", "content": PROMPTS["explain_entities"]},
-                    {"role": "user", "content": f"Category: {category}\nEntity: {item}"}
-                ]
-            )
+    entity_path = os.path.join(output_dir, base_name + ".entities.json")
+    write_output(entity_path, entities.model_dump_json(indent=2))
 
-            explanation = resp.content[0].text.strip()
-            explanations[category][item] = explanation
+    logging.info(f"[Claude] Entity extraction saved: {entity_path}")
+    return entities
+
+def explain_entities(entities, base_name, output_dir, client, model_name) -> EntityExplanations:
+    logging.info(f"[Claude] Explaining entities for {base_name}")
+    explanations = {"People": {}, "Productions": {}, "Companies": {}, "Theaters": {}}
 
-    entity_explanations = EntityExplanations(**explanations)
+    def explain_one(category, item):
+        explanation = complete(client, model_name, "explain_entities", f"Category: {category}\nEntity: {item}")
+        return category, item, explanation
+
+    def explain_window(window):
+        grouped = {}
+        for category, item in window:
+            grouped.setdefault(category, []).append(item)
+        payload = [{"category": category, "items": items} for category, items in grouped.items()]
+        request = orjson.dumps(payload).decode()
+        result = complete(client, model_name, "explain_entities_batch", request)
+
+        try:
+            parsed = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            complete.invalidate(client, model_name, "explain_entities_batch", request)
+            parsed = {}
+
+        found, missing = [], []
+        for category, item in window:
+            section = parsed.get(category)
+            explanation = section.get(item) if isinstance(section, dict) else None
+            if isinstance(explanation, str) and explanation.strip():
+                found.append((category, item, explanation.strip()))
+            else:
+                missing.append((category, item))
+        return found, missing
+
+    pairs = [(category, item) for category in explanations for item in getattr(entities, category, [])]
+    missing = []
+    with ThreadPoolExecutor(max_workers=EXPLAIN_MAX_WORKERS) as executor:
+        for found, not_found in executor.map(explain_window, split_into_batches(pairs, EXPLAIN_WINDOW)):
+            for category, item, explanation in found:
+                explanations[category][item] = explanation
+            missing.extend(not_found)
+
+        # Fall back to one request per entity for anything the batched replies missed
+        if missing:
+            logging.warning(f"[Claude] Explaining {len(missing)} entities individually for {base_name}")
+            for category, item, explanation in executor.map(lambda pair: explain_one(*pair), missing):
+                explanations[category][item] = explanation
+
+    entity_explanations = EntityExplanations.model_validate(explanations)
 
     explain_path = os.path.join(output_dir, base_name + ".entities_explained.json")
-    with open(explain_path, "w", encoding="utf-8") as f:
-        f.write(entity_explanations.model_dump_json(indent=2))
+    write_output(explain_path, entity_explanations.model_dump_json(indent=2))
 
     logging.info(f"[Claude] Entity explanations saved: {explain_path}")
     return entity_explanations
 
-def extract_page_and_split_letters(corrected_text_path, client, model_name) -> CombinedOutput:
-    with open(corrected_text_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    if not lines:
+def extract_page_and_split_letters(corrected_text_path, client, model_name, text=None) -> CombinedOutput:
+    """
+    Reads the page number and splits the corrected text into letters.
+    `text` is the corrected text when the caller already holds it, so the file is not read back.
+    """
+    full_text = text
+    if full_text is None:
+        with open(corrected_text_path, "r", encoding="utf-8") as f:
+            full_text = f.read()
+
+    if not full_text:
         return CombinedOutput(page_number=None, letters=[])
 
     # first line as page number
-    first_line = lines[0].strip()
-    full_text = "".join(lines)
-    try:
-        page_number = int(first_line)
-    except ValueError:
-        page_number = None
-
-    resp = client.messages.create(
-        model=model_name,
-        max_tokens=4096,
-        messages=[{"role": "user", "content": PROMPTS["split_letters"] + f"\nText:\n{full_text}"}]
-    )
-
-    raw_result = resp.content[0].text.strip()
+    page_number = read_page_number(full_text)
 
     try:
-        letters = json.loads(raw_result)
-        if not isinstance(letters, list):
-            letters = [full_text]
-    except json.JSONDecodeError:
-        logging.warning("[Claude] Invalid JSON when splitting letters, falling back to full text.")
+        letters = complete.validated(
+            CombinedOutput, client, model_name, "split_letters", full_text, max_tokens=8192, output_schema=CombinedOutput
+        ).letters or [full_text]
+    except ValidationError as e:
+        logging.warning(f"[Claude] Could not parse letter split for {corrected_text_path}, keeping the text whole: {e}")
         letters = [full_text]
 
-    combined = CombinedOutput(page_number=page_number, letters=letters)
+    # The page number read from the first line takes precedence over the model's
+    combined = CombinedOutput.model_construct(page_number=page_number, letters=letters)
 
     combined_path = corrected_text_path.replace(".corrected.txt", ".combined_output.json")
-    with open(combined_path, "w", encoding="utf-8") as f:
-        f.write(combined.model_dump_json(indent=2))
+    write_output(combined_path, combined.model_dump_json(indent=2))
 
     logging.info(f"[Claude] Combined output saved: {combined_path}")
-    return combined
\ No newline at end of file
+    return combined
+
+def process_document(text, base_name, output_dir, client, model_name):
+    """
+    Corrects the OCR text, extracts entities and splits letters with a single tool call.
+    Returns:
+        tuple: (CorrectedText, EntitiesOutput, CombinedOutput), each also saved to output_dir.
+    """
+    logging.info(f"[Claude] Processing {base_name} in a single call")
+    output = complete.validated(
+        CombinedPipelineOutput, client, model_name, "process_document", text, max_tokens=8192, output_schema=CombinedPipelineOutput
+    )
+
+    corrected_path = os.path.join(output_dir, base_name + ".corrected.txt")
+    write_output(corrected_path, output.corrected_text)
+
+    entity_path = os.path.join(output_dir, base_name + ".entities.json")
+    write_output(entity_path, output.entities.model_dump_json(indent=2))
+
+    # A page number on the first line takes precedence over the model's
+    page_number = read_page_number(output.corrected_text, default=output.page_number)
+    combined = CombinedOutput.model_construct(page_number=page_number, letters=output.letters or [output.corrected_text])
+
+    combined_path = os.path.join(output_dir, base_name + ".combined_output.json")
+    write_output(combined_path, combined.model_dump_json(indent=2))
+
+    logging.info(f"[Claude] Corrected text, entities and combined output saved for {base_name}")
+    return CorrectedText.model_construct(corrected_text=output.corrected_text), output.entities, combined
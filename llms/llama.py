@@ -1,98 +1,446 @@
 import os
+import re
 import logging
-import json
+import threading
+import orjson
+import httpx
+import tempfile
 import subprocess
+from urllib.parse import urlsplit
+from pydantic import ValidationError
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations
+from utils.llm_cache import cached
+from utils.concurrency import service_slot
+from utils.helpers import split_into_batches, split_into_chunks, read_page_number, write_output
+from utils.micro_batcher import MicroBatcher
+from llms._prompts import PROMPTS
+from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput, EntityExplanations, CombinedPipelineOutput
 
-PROMPTS_PATH = os.path.join(os.path.dirname(__file__), "..", "prompts.json")
-with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
-    PROMPTS = json.load(f)
+# Upper bound on concurrent per-entity explanation requests
+EXPLAIN_MAX_WORKERS = int(os.getenv("EXPLAIN_MAX_WORKERS", 4))
+# Number of entities explained together in a single request
+EXPLAIN_WINDOW = int(os.getenv("EXPLAIN_WINDOW", 25))
+# Documents corrected together in a single request (1 disables batching)
+LLAMA_BATCH_SIZE = int(os.getenv("LLAMA_BATCH_SIZE", 1))
+# Seconds a partial correction batch waits for more documents
+LLAMA_BATCH_WAIT = float(os.getenv("LLAMA_BATCH_WAIT", 2))
+# Upper bound on the text in one correction batch, in characters; the corrected copy comes
+# back in the same reply, so this stays well under the model's context window
+LLAMA_BATCH_MAX_CHARS = int(os.getenv("LLAMA_BATCH_MAX_CHARS", 12_000))
+# Correct long documents in parallel chunks split on blank lines
+LLAMA_CHUNK_CORRECT = os.getenv("LLAMA_CHUNK_CORRECT", "0") == "1"
+# Documents longer than this many characters are chunked, and no chunk exceeds it
+LLAMA_CHUNK_CHARS = int(os.getenv("LLAMA_CHUNK_CHARS", 6000))
+# Most tokens generated for a document's entities
+LLAMA_MAX_TOKENS_ENTITIES = int(os.getenv("LLAMA_MAX_TOKENS_ENTITIES", 1024))
+
+# Matches one corrected document between its sentinel lines in a batched reply
+DOC_PATTERN = re.compile(r"<<<DOC (\d+)>>>\n?(.*?)\n?<<<END \1>>>", re.DOTALL)
+
+# Markdown code fence around a JSON reply, e.g. ```json ... ```
+FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# One correction batcher per model
+_correction_batchers = {}
+_correction_batchers_lock = threading.Lock()
+
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
+# Read the way Ollama reads it: the scheme may be left out ("127.0.0.1:11434"), and so may
+# the port, which then defaults to 11434 for plain HTTP
+if "://" not in OLLAMA_HOST:
+    OLLAMA_HOST = f"http://{OLLAMA_HOST}"
+_host = urlsplit(OLLAMA_HOST)
+if _host.scheme == "http" and _host.port is None:
+    OLLAMA_HOST = _host._replace(netloc=f"{_host.netloc}:11434").geturl()
+OLLAMA_GENERATE_URL = f"{OLLAMA_HOST}/api/generate"
+# How long Ollama keeps the model loaded after a request, e.g. "30m" or "-1" for indefinitely
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Ollama reads bare numbers as seconds only when they are sent as JSON numbers
+if OLLAMA_KEEP_ALIVE.lstrip("-").isdigit():
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+# Directory for prompt files handed to the CLI fallback; tmpfs when the system has one
+PROMPT_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# Shared keep-alive connection pool to the Ollama server
+_http = httpx.Client(timeout=httpx.Timeout(600.0, connect=10.0))
 
 def get_client(api_key: Optional[str] = None):
     return None
 
-def run_ollama(model: str, prompt: str) -> str:
+def warm_up(model_name: Optional[str] = None):
+    """
+    Loads the model into memory ahead of the first document, so that request does not pay
+    the load time. A request without a prompt only loads the model and returns.
+    """
+    model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
     try:
-        result = subprocess.run(
-            ["ollama", "run", model], input=prompt.encode("utf-8"), capture_output=True, check=True,
+        response = _http.post(
+            OLLAMA_GENERATE_URL,
+            content=orjson.dumps({"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}),
+            headers={"Content-Type": "application/json"},
         )
-        return result.stdout.decode("utf-8").strip()
-    except subprocess.CalledProcessError as e:
-        logging.error(f"[LLaMA] Ollama error: {e.stderr.decode()}")
-        return ""
+        response.raise_for_status()
+        logging.info("[LLaMA] Model %s loaded", model)
+    except httpx.HTTPError as e:
+        logging.warning("[LLaMA] Could not preload %s: %s", model, e)
+
+def run_ollama_cli(model: str, prompt: str, output_format=None) -> str:
+    """
+    Runs a prompt through the `ollama` CLI; used when the HTTP API cannot be reached.
+    The CLI only supports plain JSON mode, so any `output_format` turns that on.
+    The prompt is written once to an unlinked temporary file (in memory-backed /dev/shm
+    where available) that the CLI reads as stdin, instead of being fed through a pipe.
+    Output is read in chunks as the model generates it rather than buffered until exit.
+    Stderr goes to a temporary file, so it cannot fill a pipe while stdout is read.
+    Raises RuntimeError, with the CLI's stderr, if the CLI cannot be run or fails.
+    """
+    output = bytearray()
+    try:
+        with tempfile.TemporaryFile(dir=PROMPT_TMP_DIR) as prompt_file, tempfile.TemporaryFile() as error_file:
+            prompt_file.write(prompt.encode("utf-8"))
+            prompt_file.seek(0)
+            command = ["ollama", "run", model] + (["--format", "json"] if output_format else [])
+            with subprocess.Popen(
+                command, stdin=prompt_file, stdout=subprocess.PIPE, stderr=error_file
+            ) as process:
+                while chunk := process.stdout.read1(4096):
+                    output += chunk
+            if process.returncode:
+                error_file.seek(0)
+                stderr = error_file.read().decode("utf-8", errors="replace").strip()
+                raise RuntimeError(f"Ollama CLI exited with status {process.returncode}: {stderr}")
+    except OSError as e:
+        raise RuntimeError(f"Ollama CLI error: {e}") from e
+    return output.decode("utf-8", errors="replace").strip()
+
+def run_ollama(model: str, prompt: str, output_format=None, system=None, options=None) -> str:
+    """
+    Runs a prompt through the Ollama HTTP API with a streamed response.
+    Tokens are collected as Ollama emits them (one JSON object per line) instead of
+    after the whole reply has been generated and serialized.
+    `output_format` is Ollama's `format` option: "json", or a JSON schema the reply is constrained to.
+    `system` replaces the model's system prompt, the same as a SYSTEM line in a Modelfile.
+    `options` are Ollama sampling options such as temperature and num_predict.
+    Errors are raised rather than returned as an empty reply, so callers never save one as a result.
+    """
+    parts = []
+    payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": OLLAMA_KEEP_ALIVE}
+    if output_format:
+        payload["format"] = output_format
+    if system:
+        payload["system"] = system
+    if options:
+        payload["options"] = options
+    try:
+        with service_slot("ollama"):
+            with _http.stream(
+                "POST",
+                OLLAMA_GENERATE_URL,
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = orjson.loads(line)
+                    if "error" in chunk:
+                        raise RuntimeError(f"Ollama error: {chunk['error']}")
+                    parts.append(chunk.get("response", ""))
+                    if chunk.get("done"):
+                        break
+        return "".join(parts).strip()
+    except httpx.ConnectError as e:
+        # Only when the request never reached the server; a timed-out generation is not re-run
+        logging.warning("[LLaMA] Could not reach Ollama at %s (%s), falling back to the CLI", OLLAMA_HOST, e)
+        with service_slot("ollama"):
+            return run_ollama_cli(model, f"{system}\n{prompt}" if system else prompt, output_format)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        logging.error("[LLaMA] Ollama error: %s", e)
+        raise
+
+# Output schemas for grammar-constrained decoding
+ENTITIES_FORMAT = EntitiesOutput.model_json_schema()
+LETTERS_FORMAT = {"type": "array", "items": {"type": "string"}}
+DOCUMENT_FORMAT = CombinedPipelineOutput.model_json_schema()
+
+@cached
+def complete(client, model_name, prompt_name, text, output_format=None, temperature=0.0, max_tokens=None):
+    """
+    Runs `text` through Ollama with a prompt from prompts.json as the system prompt.
+    The system prompt is identical across requests for the same step, so Ollama can reuse
+    its already-evaluated prefix instead of processing the instructions again for every document.
+    `output_format` ("json" or a JSON schema) makes the server only sample valid JSON.
+    `max_tokens` caps the reply's length, so a runaway generation stops early.
+    """
+    options = {"temperature": temperature}
+    if max_tokens:
+        options["num_predict"] = max_tokens
+    return run_ollama(model_name, text, output_format, system=PROMPTS[prompt_name], options=options)
 
-def correct_text(text: str, base_name: str, output_dir: str, model_name: Optional[str] = None, client: Optional[object] = None) -> CorrectedText:
+def json_body(response, opener):
+    """
+    Strips a Markdown code fence from a reply and checks it is bracketed like the expected JSON.
+    Args:
+        response (str): Model reply.
+        opener (str): "{" for an object, "[" for an array.
+    Returns:
+        str | None: The reply without the fence, or None if it cannot be JSON of that kind.
+    """
+    body = FENCE_PATTERN.sub("", response.strip())
+    closer = "}" if opener == "{" else "]"
+    if len(body) < 2 or body[0] != opener or body[-1] != closer:
+        return None
+    return body
+
+def correction_request(text):
+    """
+    Returns the text and options of the single-document correction request for `text`.
+    Corrections from batched requests are cached under this request too, so re-runs find
+    them whichever documents shared a batch.
+    """
+    return f"Text:\n{text}", {"max_tokens": len(text) // 2 + 256}
+
+def correct_text_batch(texts, client: Optional[object] = None, model_name: Optional[str] = None):
+    """
+    Corrects several documents with a single request, so the prompt is only ingested once.
+    Each document is wrapped in `<<<DOC i>>>` / `<<<END i>>>` lines and the reply is split on the same markers.
+    Args:
+        texts (list): OCR texts to correct.
+        client: Unused, kept for a uniform LLM module interface.
+        model_name (str): Ollama model to use.
+    Returns:
+        list: Corrected text per input, in order; None where the reply had no matching section.
+            Each correction is cached as the document's own single-document request.
+    """
+    model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
+    logging.info("[LLaMA] Correcting %d documents in one request", len(texts))
+    request = "\n".join(f"<<<DOC {i}>>>\n{text}\n<<<END {i}>>>" for i, text in enumerate(texts))
+    # The reply repeats every document with its markers, so it is about as long as the request;
+    # noisy OCR text takes more tokens per character than prose, hence the generous bound
+    max_tokens = len(request) // 2 + 256
+    # Sent uncached: which documents share a batch varies from run to run
+    response = complete.__wrapped__(client, model, "correct_text_batch", request, max_tokens=max_tokens)
+
+    by_id = {int(doc_id): corrected.strip() for doc_id, corrected in DOC_PATTERN.findall(response)}
+    results = [by_id.get(i) or None for i in range(len(texts))]
+    for text, corrected in zip(texts, results):
+        if corrected:
+            single_text, options = correction_request(text)
+            complete.store(corrected, client, model, "correct_text", single_text, **options)
+    return results
+
+def get_correction_batcher(client, model):
+    """Returns the shared batcher that groups correction requests from concurrent documents."""
+    with _correction_batchers_lock:
+        if model not in _correction_batchers:
+            _correction_batchers[model] = MicroBatcher(
+                lambda texts: correct_text_batch(texts, client, model),
+                LLAMA_BATCH_SIZE, LLAMA_BATCH_WAIT, max_size=LLAMA_BATCH_MAX_CHARS,
+            )
+        return _correction_batchers[model]
+
+def correct_text(text: str, base_name: str, output_dir: str, client: Optional[object] = None, model_name: Optional[str] = None) -> CorrectedText:
     model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
 
-    corrected = run_ollama(model, PROMPTS["correct_text"] + f"\nText:\n{text}")
+    def correct_one(part):
+        single_text, options = correction_request(part)
+        return complete(client, model, "correct_text", single_text, **options)
+
+    corrected = None
+    if LLAMA_BATCH_SIZE > 1 and len(text) < LLAMA_BATCH_MAX_CHARS:
+        # A correction cached by an earlier run is used without waiting for a batch
+        single_text, options = correction_request(text)
+        corrected = complete.lookup(client, model, "correct_text", single_text, **options)
+    if corrected is None and LLAMA_BATCH_SIZE > 1 and len(text) < LLAMA_BATCH_MAX_CHARS:
+        try:
+            corrected = get_correction_batcher(client, model).submit(text).result()
+        except Exception as e:
+            logging.warning("[LLaMA] Batched correction failed for %s: %s", base_name, e)
+        if corrected is None:
+            logging.info("[LLaMA] Correcting %s on its own", base_name)
+
+    def correct_chunk(chunk):
+        # Only the text goes to the model; the newlines around it are kept as they were
+        body = chunk.strip()
+        if not body:
+            return chunk
+        start = chunk.index(body)
+        return chunk[:start] + correct_one(body) + chunk[start + len(body):]
+
+    if corrected is None and LLAMA_CHUNK_CORRECT and len(text) > LLAMA_CHUNK_CHARS:
+        # The prompt forbids adding content, so chunks corrected on their own join back up
+        chunks = split_into_chunks(text, LLAMA_CHUNK_CHARS)
+        logging.info("[LLaMA] Correcting %s in %d chunks", base_name, sum(1 for chunk in chunks if chunk.strip()))
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            corrected = "".join(executor.map(correct_chunk, chunks))
+
+    if corrected is None:
+        corrected = correct_one(text)
 
     corrected_path = os.path.join(output_dir, base_name + ".corrected.txt")
-    with open(corrected_path, "w", encoding="utf-8") as f:
-        f.write(corrected)
+    write_output(corrected_path, corrected)
 
-    logging.info(f"[LLaMA] Corrected text saved: {corrected_path}")
-    return CorrectedText(corrected_text=corrected)
+    logging.info("[LLaMA] Corrected text saved: %s", corrected_path)
+    return CorrectedText.model_construct(corrected_text=corrected)
 
-def extract_entities(text: str, base_name: str, output_dir: str, model_name: Optional[str] = None, client: Optional[object] = None) -> EntitiesOutput:
+def extract_entities(text: str, base_name: str, output_dir: str, client: Optional[object] = None, model_name: Optional[str] = None) -> EntitiesOutput:
     model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
-    response = run_ollama(model, PROMPTS["extract_entities"] + f"\nText:\n{text}")
+    options = {"output_format": ENTITIES_FORMAT, "max_tokens": LLAMA_MAX_TOKENS_ENTITIES}
+    response = complete(client, model, "extract_entities", f"Text:\n{text}", **options)
 
-    try:
-        parsed = json.loads(response)
-    except json.JSONDecodeError:
-        parsed = {"People": [], "Productions": [], "Companies": [], "Theaters": [], "Dates": []}
-
-    entities = EntitiesOutput(**parsed)
+    # Decoding is constrained to the schema; this only catches servers too old to enforce it
+    # and the CLI fallback, whose replies may be prose or fenced
+    entities = None
+    body = json_body(response, "{")
+    if body is not None:
+        try:
+            entities = EntitiesOutput.model_validate_json(body)
+        except ValidationError:
+            pass
+    if entities is None:
+        # Nothing is saved, so the next run extracts the entities again
+        complete.invalidate(client, model, "extract_entities", f"Text:\n{text}", **options)
+        raise ValueError(f"LLaMA returned no valid entities for {base_name}")
 
     path = os.path.join(output_dir, base_name + ".entities.json")
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(entities.model_dump_json(indent=2))
+    write_output(path, entities.model_dump_json(indent=2))
 
-    logging.info(f"[LLaMA] Entities saved: {path}")
+    logging.info("[LLaMA] Entities saved: %s", path)
     return entities
 
-def explain_entities(entities, base_name, output_dir, model_name: Optional[str] = None, client: Optional[object] = None) -> EntityExplanations:
-    logging.info(f"[LLaMA] Explaining entities for {base_name}")
+def explain_entities(entities, base_name, output_dir, client: Optional[object] = None, model_name: Optional[str] = None) -> EntityExplanations:
+    logging.info("[LLaMA] Explaining entities for %s", base_name)
     explanations = {"People": {}, "Productions": {}, "Companies": {}, "Theaters": {}}
     model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
 
-    for category in explanations.keys():
-        items = getattr(entities, category, [])
-        for item in items:
-            response = run_ollama(model, PROMPTS["explain_entities"] + f"\nCategory: {category}\nEntity: {item}")
-            explanations[category][item] = response.strip()
+    def explain_one(category, item):
+        response = complete(client, model, "explain_entities", f"Category: {category}\nEntity: {item}", temperature=0.2)
+        return category, item, response.strip()
+
+    def explain_window(window):
+        grouped = {}
+        for category, item in window:
+            grouped.setdefault(category, []).append(item)
+        payload = [{"category": category, "items": items} for category, items in grouped.items()]
+        request = orjson.dumps(payload).decode()
+        result = complete(client, model, "explain_entities_batch", request, output_format="json", temperature=0.2)
+
+        parsed = None
+        body = json_body(result, "{")
+        if body is not None:
+            try:
+                parsed = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                pass
+        if not isinstance(parsed, dict):
+            complete.invalidate(client, model, "explain_entities_batch", request, output_format="json", temperature=0.2)
+            parsed = {}
+
+        found, missing = [], []
+        for category, item in window:
+            section = parsed.get(category)
+            explanation = section.get(item) if isinstance(section, dict) else None
+            if isinstance(explanation, str) and explanation.strip():
+                found.append((category, item, explanation.strip()))
+            else:
+                missing.append((category, item))
+        return found, missing
+
+    pairs = [(category, item) for category in explanations for item in getattr(entities, category, [])]
+    missing = []
+    with ThreadPoolExecutor(max_workers=EXPLAIN_MAX_WORKERS) as executor:
+        for found, not_found in executor.map(explain_window, split_into_batches(pairs, EXPLAIN_WINDOW)):
+            for category, item, explanation in found:
+                explanations[category][item] = explanation
+            missing.extend(not_found)
 
-    entity_explanations = EntityExplanations(**explanations)
+        # Fall back to one request per entity for anything the batched replies missed
+        if missing:
+            logging.warning("[LLaMA] Explaining %d entities individually for %s", len(missing), base_name)
+            for category, item, explanation in executor.map(lambda pair: explain_one(*pair), missing):
+                explanations[category][item] = explanation
+
+    entity_explanations = EntityExplanations.model_validate(explanations)
 
     explain_path = os.path.join(output_dir, base_name + ".entities_explained.json")
-    with open(explain_path, "w", encoding="utf-8") as f:
-        f.write(entity_explanations.model_dump_json(indent=2))
+    write_output(explain_path, entity_explanations.model_dump_json(indent=2))
 
-    logging.info(f"[LLaMA] Entity explanations saved: {explain_path}")
+    logging.info("[LLaMA] Entity explanations saved: %s", explain_path)
     return entity_explanations
 
-def extract_page_and_split_letters(corrected_path: str,model_name: Optional[str] = None, client: Optional[object] = None) -> CombinedOutput:
+def extract_page_and_split_letters(corrected_path: str, client: Optional[object] = None, model_name: Optional[str] = None, text: Optional[str] = None) -> CombinedOutput:
+    """
+    Reads the page number and splits the corrected text into letters.
+    `text` is the corrected text when the caller already holds it, so the file is not read back.
+    """
     model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
 
-    with open(corrected_path, "r", encoding="utf-8") as f:
-        text = f.read()
+    if text is None:
+        with open(corrected_path, "r", encoding="utf-8") as f:
+            text = f.read()
 
     # First line may be a page number
-    lines = text.splitlines()
-    try:
-        page_number = int(lines[0].strip())
-    except (ValueError, IndexError):
-        page_number = None
+    page_number = read_page_number(text)
 
-    response = run_ollama(model, PROMPTS["split_letters"] + f"\nText:\n{text}")
+    # Letters repeat the whole text, plus JSON quoting and escapes
+    options = {"output_format": LETTERS_FORMAT, "max_tokens": len(text) // 3 + 512}
+    response = complete(client, model, "split_letters", f"Text:\n{text}", **options)
 
-    try:
-        letters = json.loads(response)
-        if not isinstance(letters, list):
-            letters = [text]
-    except json.JSONDecodeError:
+    letters = None
+    body = json_body(response, "[")
+    if body is not None:
+        try:
+            letters = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            pass
+    if not isinstance(letters, list):
+        complete.invalidate(client, model, "split_letters", f"Text:\n{text}", **options)
         letters = [text]
 
-    logging.info(f"[LLaMA] Split into {len(letters)} sections.")
-    return CombinedOutput(page_number=page_number, letters=letters)
\ No newline at end of file
+    logging.info("[LLaMA] Split into %d sections.", len(letters))
+    combined = CombinedOutput(page_number=page_number, letters=letters)
+
+    combined_path = corrected_path.replace(".corrected.txt", ".combined_output.json")
+    write_output(combined_path, combined.model_dump_json(indent=2))
+
+    logging.info("[LLaMA] Combined output saved: %s", combined_path)
+    return combined
+
+def process_document(text: str, base_name: str, output_dir: str, client: Optional[object] = None, model_name: Optional[str] = None):
+    """
+    Corrects the OCR text, extracts entities and splits letters with a single schema-constrained
+    request, so Ollama processes the document text once instead of three times.
+    Returns:
+        tuple: (CorrectedText, EntitiesOutput, CombinedOutput), each also saved to output_dir.
+    """
+    model = model_name or os.getenv("LLAMA_MODEL", "llama3.1:8b")
+    logging.info("[LLaMA] Processing %s in a single call", base_name)
+    # The reply holds the text twice (corrected, and split into letters) plus the entities
+    options = {"output_format": DOCUMENT_FORMAT, "max_tokens": len(text) + LLAMA_MAX_TOKENS_ENTITIES + 256}
+    result = complete(client, model, "process_document", f"Text:\n{text}", **options)
+
+    body = json_body(result, "{")
+    try:
+        if body is None:
+            raise ValueError("reply is not a JSON object")
+        output = CombinedPipelineOutput.model_validate_json(body)
+    except ValueError:
+        complete.invalidate(client, model, "process_document", f"Text:\n{text}", **options)
+        raise
+
+    corrected_path = os.path.join(output_dir, base_name + ".corrected.txt")
+    write_output(corrected_path, output.corrected_text)
+
+    entity_path = os.path.join(output_dir, base_name + ".entities.json")
+    write_output(entity_path, output.entities.model_dump_json(indent=2))
+
+    # A page number on the first line takes precedence over the model's
+    page_number = read_page_number(output.corrected_text, default=output.page_number)
+    combined = CombinedOutput.model_construct(page_number=page_number, letters=output.letters or [output.corrected_text])
+
+    combined_path = os.path.join(output_dir, base_name + ".combined_output.json")
+    write_output(combined_path, combined.model_dump_json(indent=2))
+
+    logging.info("[LLaMA] Corrected text, entities and combined output saved for %s", base_name)
+    return CorrectedText.model_construct(corrected_text=output.corrected_text), output.entities, combined
@@ -3,8 +3,8 @@ import logging
 import time
 import importlib
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils.helpers import initialize_logging, split_into_batches, clean_tmp_folder, log_runtime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.helpers import initialize_logging, clean_tmp_folder, log_runtime
 
 # --- Load environment variables ---
 load_dotenv()
@@ -16,12 +16,14 @@ output_dir = os.environ.get("OUTPUT_DIR")
 
 # General params
 max_threads = int(os.environ.get("MAX_THREADS", 4))
-batch_size = int(os.environ.get("BATCH_SIZE", 5))
+prepare_threads = int(os.environ.get("PREPARE_THREADS", os.cpu_count() or 4))  # Threads for file conversion
+batch_size = int(os.environ.get("BATCH_SIZE", 5))  # Max documents in the pipeline at once
 image_magick_command = os.environ.get("IMAGE_MAGICK_COMMAND", "convert")
 
 # Providers
 ocr_provider = os.getenv("OCR_PROVIDER", "aws").lower()
 llm_provider = os.getenv("LLM_PROVIDER", "chatgpt").lower()
+use_batch_api = os.getenv("USE_BATCH_API", "0") == "1"
 
 # --- Choose API key + model dynamically ---
 api_key, model_name = None, None
@@ -60,6 +62,13 @@ except ModuleNotFoundError as e:
     logging.error(f"Provider import error: {e}")
     raise
 
+if use_batch_api and llm_provider != "chatgpt":
+    logging.warning(f"USE_BATCH_API is only supported for chatgpt, not {llm_provider} — using real-time calls.")
+    use_batch_api = False
+if use_batch_api:
+    batch_module = importlib.import_module("llms.chatgpt_batch")
+    batch_documents = {}
+
 # --- Collect files ---
 if not input_dir or not os.path.isdir(input_dir):
     logging.error("INPUT_DIR is not set or does not exist.")
@@ -73,48 +82,90 @@ else:
 if not files:
     logging.warning("No input files found to process.")
 
-batches = list(split_into_batches(files, batch_size))
-logging.info(f"Batch size: {batch_size} | Max Threads: {max_threads} | Total files: {len(files)}")
-
-# --- Process in batches ---
-for batch_index, current_batch in enumerate(batches):
-    logging.info(f"Processing batch {batch_index + 1} of {len(batches)}")
-
+# Largest files first: long documents start early instead of becoming the run's straggler
+files.sort(key=lambda f: os.path.getsize(os.path.join(input_dir, f)), reverse=True)
+
+logging.info(f"Batch size: {batch_size} | Max Threads: {max_threads} | Prepare Threads: {prepare_threads} | Total files: {len(files)}")
+
+STAGE_ERRORS = {
+    "prepare": "Prep failed for",
+    "ocr": "Waiting on OCR failed for",
+    "process": "Processing failed for",
+}
+
+def submit_next_file(executor, pending_files, stages):
+    """Starts preparing the next input file, if any are left."""
+    filename = next(pending_files, None)
+    if filename is not None:
+        future = executor.submit(
+            ocr_module.prepare_file, filename, tmp_dir, input_dir, output_dir, image_magick_command, **service_options,
+        )
+        stages[future] = ("prepare", filename)
+
+# --- Process files as a stream ---
+# Each file moves prepare -> (remote OCR wait) -> process as soon as its previous stage
+# finishes, with at most `batch_size` files in flight. File conversion runs on its own pool
+# sized to the CPUs, so it keeps going while every processing worker waits on an API;
+# per-service limits (utils.concurrency) cap the requests each external API sees.
+with ThreadPoolExecutor(max_workers=prepare_threads) as prepare_executor, \
+        ThreadPoolExecutor(max_workers=max_threads) as executor:
+    process_llm_module = None if use_batch_api else llm_module
+    # Load a local model while the first files are still in OCR
+    if process_llm_module and files and hasattr(llm_module, "warm_up"):
+        executor.submit(llm_module.warm_up, model_name)
+    pending_files = iter(files)
+    stages = {}
     jobs = {}
 
-    # --- Prepare files in parallel ---
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = {
-            executor.submit(
-                ocr_module.prepare_file, filename, tmp_dir, input_dir, output_dir, image_magick_command, **service_options,
-            ): filename
-            for filename in current_batch
-        }
-        for future in as_completed(futures):
-            filename = futures[future]
+    for _ in range(batch_size):
+        submit_next_file(prepare_executor, pending_files, stages)
+
+    while stages:
+        done, _ = wait(stages, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, name = stages.pop(future)
             try:
                 result = future.result()
-                if result:
-                    base_name, job_info = result
-                    jobs[base_name] = job_info
             except Exception as e:
-                logging.error(f"Prep failed for {filename}: {e}", exc_info=True)
-
-    # --- Process results in parallel ---
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = {
-            executor.submit(
-                ocr_module.process_file, base_name, job_info, llm_module, model_name, api_key,
-            ): base_name
-            for base_name, job_info in jobs.items()
-        }
-        for future in as_completed(futures):
-            base_name = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                logging.error(f"Processing failed for {base_name}: {e}", exc_info=True)
-
+                logging.error(f"{STAGE_ERRORS[stage]} {name}: {e}", exc_info=True)
+                result = None
+
+            if stage == "prepare" and result:
+                base_name, job_info = result
+                jobs[base_name] = job_info
+                if hasattr(ocr_module, "watch_job"):
+                    # Remote OCR jobs are awaited on the provider's monitor; a file only
+                    # takes a worker thread once its OCR result is ready.
+                    stages[ocr_module.watch_job(job_info)] = ("ocr", base_name)
+                else:
+                    stages[executor.submit(
+                        ocr_module.process_file, base_name, job_info, process_llm_module, model_name, api_key,
+                    )] = ("process", base_name)
+                continue
+
+            if stage == "ocr" and result:
+                stages[executor.submit(
+                    ocr_module.process_file, name, jobs[name], process_llm_module, model_name, api_key,
+                )] = ("process", name)
+                continue
+
+            if stage == "ocr" and result is False:
+                logging.error(f"OCR job did not succeed for {name}")
+            if stage == "process" and use_batch_api and result and result.get("status") == "ocr_only":
+                batch_documents[name] = result["raw_path"]
+
+            # The file has left the pipeline; admit the next one
+            jobs.pop(name, None)
+            submit_next_file(prepare_executor, pending_files, stages)
+
+if hasattr(ocr_module, "cleanup"):
+    ocr_module.cleanup(**service_options)
+clean_tmp_folder(tmp_dir)
+
+# --- LLM post-processing via the Batch API ---
+if use_batch_api and batch_documents:
+    logging.info(f"Submitting {len(batch_documents)} documents to the OpenAI Batch API")
+    batch_module.process_documents(batch_documents, tmp_dir, llm_module.get_client(api_key), model_name)
     clean_tmp_folder(tmp_dir)
 
 log_runtime(start_time)
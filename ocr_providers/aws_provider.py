@@ -1,10 +1,33 @@
 import os
 import logging
-import json
 import boto3
+from functools import lru_cache
+from concurrent.futures import Future
 from botocore.config import Config
-from utils.helpers import get_file_paths, convert_to_pdf
-from utils.aws_utils import (upload_file_to_s3, start_textract_job, wait_for_completion, extract_and_save_text_and_coords, delete_all_files_in_bucket)
+from utils.helpers import get_file_paths, convert_to_pdf, is_up_to_date
+from utils.concurrency import service_slot
+from utils.llm_pipeline import run_llm_pipeline
+from utils.aws_utils import (upload_file_to_s3, start_textract_job, wait_for_completion, extract_and_save_text_and_coords, delete_all_files_in_bucket, TextractJobMonitor)
+
+TEXTRACT_MAX_RETRIES = int(os.getenv("TEXTRACT_MAX_RETRIES", 120))
+TEXTRACT_DELAY = int(os.getenv("TEXTRACT_DELAY", 5))
+
+# One Textract job monitor per region
+_monitors = {}
+
+@lru_cache(maxsize=8)
+def get_clients(region):
+    """
+    Returns S3 and Textract clients for a region, created once and shared across files.
+    The connection pool is sized for every worker thread to hold a connection.
+    """
+    boto_config = Config(
+        max_pool_connections=max(32, int(os.getenv("MAX_THREADS", 4)) * 2),
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    )
+    s3 = boto3.client("s3", region_name=region, config=boto_config)
+    textract = boto3.client("textract", region_name=region, config=boto_config)
+    return s3, textract
 
 def prepare_file(filename, tmp_dir, input_dir, output_dir, image_magick_command, **kwargs):
     bucket_name = kwargs.get("bucket_name")
@@ -13,14 +36,22 @@ def prepare_file(filename, tmp_dir, input_dir, output_dir, image_magick_command,
     if not bucket_name or not region:
         raise ValueError("AWS provider requires both bucket_name and region")
 
-    boto_config = Config(max_pool_connections=16)
-    s3 = boto3.client("s3", region_name=region, config=boto_config)
-    textract = boto3.client("textract", region_name=region, config=boto_config)
+    s3, textract = get_clients(region)
 
     paths = get_file_paths(filename, tmp_dir, input_dir, output_dir)
     base_name = paths["base_name"]
     os.makedirs(paths["doc_output_dir"], exist_ok=True)
 
+    # Skip the upload and Textract job when a previous run already has the OCR text;
+    # documents it finished entirely are skipped as a whole
+    raw_path = os.path.join(paths["doc_output_dir"], base_name + ".raw.txt")
+    if is_up_to_date(raw_path, paths["path_to_file"]):
+        if is_up_to_date(os.path.join(paths["doc_output_dir"], base_name + ".combined_output.json"), raw_path):
+            logging.info(f"[AWS] {filename} already processed, skipping")
+            return base_name, {"cached": True, "doc_output_dir": paths["doc_output_dir"], "region": region}
+        logging.info(f"[AWS] Reusing OCR text for {filename}")
+        return base_name, {"raw_ready": True, "doc_output_dir": paths["doc_output_dir"], "region": region}
+
     ext = os.path.splitext(filename)[1].lower()
     pdf_to_upload = paths["pdf_file"] if ext != ".pdf" else paths["path_to_file"]
 
@@ -32,7 +63,12 @@ def prepare_file(filename, tmp_dir, input_dir, output_dir, image_magick_command,
     upload_file_to_s3(pdf_to_upload, s3, bucket_name, paths["s3_pdf_key"])
     logging.info(f"[AWS] Uploaded {filename} to S3 as {paths['s3_pdf_key']}")
 
-    job_id = start_textract_job(paths["s3_pdf_key"], textract, bucket_name)
+    # Textract reads the copy in S3, so the converted PDF is not kept in TMP_DIR for the rest of the run
+    if ext != ".pdf" and os.path.exists(paths["pdf_file"]):
+        os.remove(paths["pdf_file"])
+
+    with service_slot("ocr"):
+        job_id = start_textract_job(paths["s3_pdf_key"], textract, bucket_name)
     logging.info(f"[AWS] Started Textract job {job_id} for {filename}")
 
     return base_name, {
@@ -43,93 +79,80 @@ def prepare_file(filename, tmp_dir, input_dir, output_dir, image_magick_command,
         "region": region,
     }
 
+def cleanup(**kwargs):
+    """Empties the S3 bucket once a batch is done; per-file cleanup would delete PDFs other jobs still read."""
+    bucket_name = kwargs.get("bucket_name")
+    region = kwargs.get("region")
+    if not bucket_name or not region:
+        return
+
+    s3, _ = get_clients(region)
+    delete_all_files_in_bucket(s3, bucket_name)
+    logging.info(f"[AWS] Cleaned up S3 bucket: {bucket_name}")
+
+def watch_job(job_info):
+    """
+    Waits for the document's Textract job on a shared monitor thread instead of a worker thread.
+    Returns a Future that resolves to True once the job has succeeded; `process_file` then
+    skips its own polling.
+    """
+    ready = Future()
+    if job_info.get("cached") or job_info.get("raw_ready"):
+        ready.set_result(True)
+        return ready
+
+    region = job_info["region"]
+    if region not in _monitors:
+        _, textract = get_clients(region)
+        _monitors[region] = TextractJobMonitor(textract, TEXTRACT_MAX_RETRIES, TEXTRACT_DELAY)
+
+    def on_done(status_future):
+        try:
+            job_info["textract_status"] = status_future.result()
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(job_info["textract_status"] == "SUCCEEDED")
+
+    _monitors[region].watch(job_info["job_id"]).add_done_callback(on_done)
+    return ready
+
 def process_file(base_name, job_info, llm_module, model_name, api_key):
-    boto_config = Config(max_pool_connections=16)
-    textract = boto3.client("textract", region_name=job_info["region"], config=boto_config)
-    s3 = boto3.client("s3", region_name=job_info["region"], config=boto_config)
+    raw_path = os.path.join(job_info["doc_output_dir"], base_name + ".raw.txt")
+    combined_path = os.path.join(job_info["doc_output_dir"], base_name + ".combined_output.json")
+
+    # --- Already processed by a previous run ---
+    if job_info.get("cached"):
+        logging.info(f"[AWS] Reusing existing output for {base_name}")
+        return {"status": "cached", "base_name": base_name, "raw_path": raw_path, "combined_path": combined_path}
 
-    logging.info(f"[AWS] Waiting on Textract for {base_name}.pdf")
+    # --- OCR text from a previous run ---
+    if job_info.get("raw_ready"):
+        if llm_module is None:
+            return {"status": "ocr_only", "base_name": base_name, "raw_path": raw_path}
+        with open(raw_path, "r", encoding="utf-8") as f:
+            raw_text = f.read()
+        return run_llm_pipeline(raw_text, raw_path, base_name, job_info["doc_output_dir"], llm_module, model_name, api_key)
 
-    # --- Wait for Textract job ---
-    finished = wait_for_completion(job_info["job_id"], textract, max_retries=120, delay=5)
+    _, textract = get_clients(job_info["region"])
+
+    # --- Wait for Textract job (unless already watched via watch_job) ---
+    finished = job_info.get("textract_status") == "SUCCEEDED"
+    if not finished:
+        logging.info(f"[AWS] Waiting on Textract for {base_name}.pdf")
+        finished = wait_for_completion(job_info["job_id"], textract, max_retries=TEXTRACT_MAX_RETRIES, delay=TEXTRACT_DELAY)
     if not finished:
         logging.error(f"[AWS] Textract did not finish for {base_name}")
         return {"status": "failed", "reason": "textract_timeout", "base_name": base_name}
 
     # --- Save raw + coords ---
-    extract_and_save_text_and_coords(job_info["job_id"], base_name, job_info["doc_output_dir"], textract)
-    raw_path = os.path.join(job_info["doc_output_dir"], base_name + ".raw.txt")
+    with service_slot("ocr"):
+        raw_text, confidence = extract_and_save_text_and_coords(job_info["job_id"], base_name, job_info["doc_output_dir"], textract)
+
+    # --- LLM post-processing deferred (e.g. OpenAI Batch API) ---
+    if llm_module is None:
+        return {"status": "ocr_only", "base_name": base_name, "raw_path": raw_path}
 
-    with open(raw_path, "r", encoding="utf-8") as f:
-        raw_text = f.read()
-
-    # --- LLM client ---
-    client = llm_module.get_client(api_key)
-
-    # --- Correct text ---
-    corrected_obj = None
-    try:
-        corrected_obj = llm_module.correct_text(raw_text, base_name, job_info["doc_output_dir"], client, model_name)
-    except Exception as e:
-        logging.warning(f"[AWS] Correction failed for {base_name}: {e}")
-
-    corrected_path = os.path.join(job_info["doc_output_dir"], base_name + ".corrected.txt")
-    text_for_entities = raw_text
-
-    if corrected_obj:
-        text_for_entities = corrected_obj.corrected_text
-        with open(corrected_path, "w", encoding="utf-8") as f:
-            f.write(text_for_entities)
-        logging.info(f"[AWS] Corrected text saved: {corrected_path}")
-
-    # --- Extract entities ---
-    try:
-        entities = llm_module.extract_entities(
-            text_for_entities, base_name, job_info["doc_output_dir"], client, model_name
-        )
-        if entities:
-            logging.info(f"[AWS] Entities extracted for {base_name}")
-    except Exception as e:
-        logging.warning(f"[AWS] Entity extraction failed for {base_name}: {e}")
-        entities = {}
-
-    # --- Explain entities ---
-    try:
-        explanations = llm_module.explain_entities(
-            entities, base_name, job_info["doc_output_dir"], client, model_name
-        )
-    except Exception as e:
-        logging.warning(f"[Provider] Entity explanation failed for {base_name}: {e}")
-
-    # --- Split into letters ---
-    combined = None
-    try:
-        combined = llm_module.extract_page_and_split_letters(corrected_path, client, model_name)
-        if combined:
-            combined_path = os.path.join(job_info["doc_output_dir"], base_name + ".combined_output.json")
-            with open(combined_path, "w", encoding="utf-8") as f:
-                json.dump(
-                    combined.model_dump() if hasattr(combined, "model_dump") else combined,
-                    f,
-                    indent=2,
-                    ensure_ascii=False,
-                )
-            logging.info(f"[AWS] Combined output saved: {combined_path}")
-    except Exception as e:
-        logging.warning(f"[AWS] Letter splitting failed for {base_name}: {e}")
-
-    # --- Cleanup bucket ---
-    try:
-        delete_all_files_in_bucket(s3, job_info["bucket_name"])
-        logging.info(f"[AWS] Cleaned up S3 bucket: {job_info['bucket_name']}")
-    except Exception as e:
-        logging.warning(f"[AWS] Cleanup failed for {base_name}: {e}")
-
-    return {
-        "status": "success",
-        "base_name": base_name,
-        "raw_path": raw_path,
-        "corrected_path": corrected_path if corrected_obj else None,
-        "entities": entities if entities else None,
-        "combined_path": combined_path if combined else None,
-    }
\ No newline at end of file
+    return run_llm_pipeline(
+        raw_text, raw_path, base_name, job_info["doc_output_dir"], llm_module, model_name, api_key, confidence=confidence
+    )
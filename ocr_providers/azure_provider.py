@@ -1,142 +1,162 @@
 import os
 import logging
-import json
+import orjson
 import mimetypes
+import threading
+from functools import lru_cache
+from concurrent.futures import Future
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
-from utils.helpers import get_file_paths, convert_to_pdf, resize_image
+from utils.helpers import get_file_paths, resize_image_bytes, is_up_to_date, write_output
+from utils.concurrency import service_slot
+from utils.llm_pipeline import run_llm_pipeline
+
+@lru_cache(maxsize=1)
+def get_client():
+    """Returns one Document Intelligence client shared across files, so connections are reused."""
+    endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
+    key = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")
+    if not endpoint or not key:
+        raise ValueError("Azure endpoint/key not set")
+    return DocumentIntelligenceClient(endpoint, AzureKeyCredential(key))
+
+def start_analysis(client, source, content_type):
+    """
+    Starts a prebuilt-read analysis.
+    Throttling and transient errors are retried by azure-core's retry policy, which
+    rewinds the file before sending it again.
+    Args:
+        client (DocumentIntelligenceClient): Shared Document Intelligence client.
+        source (bytes | str): Document contents, or the path of a file to stream.
+            Files are passed as an open handle, so the transport streams them in
+            blocks rather than holding them in memory.
+        content_type (str): MIME type of the document.
+    Returns:
+        LROPoller: Poller for the analysis.
+    """
+    if isinstance(source, bytes):
+        return client.begin_analyze_document(model_id="prebuilt-read", body=source, content_type=content_type)
+    with open(source, "rb") as f:
+        return client.begin_analyze_document(model_id="prebuilt-read", body=f, content_type=content_type)
 
 def prepare_file(filename, tmp_dir, input_dir, output_dir, image_magick_command, **kwargs):
+    client = get_client()
+
     paths = get_file_paths(filename, tmp_dir, input_dir, output_dir)
     base_name = paths["base_name"]
     os.makedirs(paths["doc_output_dir"], exist_ok=True)
 
+    # Skip OCR when a previous run already has the OCR text;
+    # documents it finished entirely are skipped as a whole
+    raw_path = os.path.join(paths["doc_output_dir"], base_name + ".raw.txt")
+    if is_up_to_date(raw_path, paths["path_to_file"]):
+        if is_up_to_date(os.path.join(paths["doc_output_dir"], base_name + ".combined_output.json"), raw_path):
+            logging.info(f"[Azure] {filename} already processed, skipping")
+            return base_name, {"cached": True, "doc_output_dir": paths["doc_output_dir"]}
+        logging.info(f"[Azure] Reusing OCR text for {filename}")
+        return base_name, {"raw_ready": True, "doc_output_dir": paths["doc_output_dir"]}
+
     ext = os.path.splitext(filename)[1].lower()
 
+    # Images are resized in memory and sent straight from ImageMagick's output;
+    # PDFs are streamed from the input file as they are.
     if ext in [".jpg", ".jpeg", ".png", ".tif", ".tiff"]:
-        resized_path = os.path.join(tmp_dir, f"{base_name}_resized{ext}")
-        prepared_file = resize_image(paths["path_to_file"], resized_path, image_magick_command, filename)
-        logging.info(f"[Azure] Resized image prepared: {prepared_file}")
+        source = resize_image_bytes(paths["path_to_file"], image_magick_command, filename)
+        logging.info(f"[Azure] Resized image prepared: {filename} ({len(source)} bytes)")
     else:
-        convert_to_pdf(paths["path_to_file"], paths["pdf_file"], image_magick_command, filename)
-        prepared_file = paths["pdf_file"]
-        logging.info(f"[Azure] PDF prepared: {prepared_file}")
+        source = paths["path_to_file"]
+
+    content_type, _ = mimetypes.guess_type(filename)
+    content_type = content_type or "application/octet-stream"
+
+    # --- Start OCR ---
+    # The poller polls the long-running operation on its own thread; the OCR slot is
+    # held until it finishes and released by the callback registered in watch_job.
+    service_slot("ocr").acquire()
+    try:
+        poller = start_analysis(client, source, content_type)
+    except Exception:
+        service_slot("ocr").release()
+        raise
+    logging.info(f"[Azure] Started OCR on {filename}")
 
     return base_name, {
         "doc_output_dir": paths["doc_output_dir"],
-        "prepared_file": prepared_file,
+        "poller": poller,
     }
 
+def watch_job(job_info):
+    """
+    Waits for the document's analyze operation without tying up a worker thread.
+    Returns a Future that resolves to True once the operation has finished, successfully
+    or not; `process_file` surfaces any OCR error when it reads the result.
+    """
+    ready = Future()
+    if job_info.get("cached") or job_info.get("raw_ready"):
+        ready.set_result(True)
+        return ready
 
-def process_file(base_name, job_info, llm_module, model_name, api_key):
-    endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
-    key = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")
-    if not endpoint or not key:
-        raise ValueError("Azure endpoint/key not set")
-
-    client = DocumentIntelligenceClient(endpoint, AzureKeyCredential(key))
+    # azure-core can run the callback twice: at once if the poller is already done, and again
+    # from its polling thread; the OCR slot is released and the future resolved only the first time
+    fired = threading.Lock()
 
-    prepared_file = job_info["prepared_file"]
-    content_type, _ = mimetypes.guess_type(prepared_file)
-    content_type = content_type or "application/octet-stream"
+    def on_done(_):
+        if not fired.acquire(blocking=False):
+            return
+        service_slot("ocr").release()
+        ready.set_result(True)
 
-    logging.info(f"[Azure] Running OCR on {base_name} ({os.path.basename(prepared_file)})")
-
-    # --- OCR ---
-    with open(prepared_file, "rb") as f:
-        poller = client.begin_analyze_document(
-            model_id="prebuilt-read",
-            body=f,
-            content_type=content_type,
-        )
-    result = poller.result()
-
-    # --- Collect OCR results ---
-    ocr_lines, coords_data = [], []
-    for page_num, page in enumerate(result.pages or [], start=1):
-        for line in (page.lines or []):
-            ocr_lines.append(line.content)
-            coords_data.append({
-                "page": page_num,
-                "text": line.content,
-                "boundingBox": line.polygon or []
-            })
-
-    if not ocr_lines:
-        logging.warning(f"[Azure] No OCR text detected in {base_name}")
+    job_info["poller"].add_done_callback(on_done)
+    return ready
 
-    raw_text = "\n".join(ocr_lines)
 
-    # --- Save raw text ---
+def process_file(base_name, job_info, llm_module, model_name, api_key):
     raw_path = os.path.join(job_info["doc_output_dir"], base_name + ".raw.txt")
-    with open(raw_path, "w", encoding="utf-8") as f:
-        f.write(raw_text)
+    combined_path = os.path.join(job_info["doc_output_dir"], base_name + ".combined_output.json")
+
+    # --- Already processed by a previous run ---
+    if job_info.get("cached"):
+        logging.info(f"[Azure] Reusing existing output for {base_name}")
+        return {"status": "cached", "base_name": base_name, "raw_path": raw_path, "combined_path": combined_path}
+
+    # --- OCR text from a previous run ---
+    if job_info.get("raw_ready"):
+        if llm_module is None:
+            return {"status": "ocr_only", "base_name": base_name, "raw_path": raw_path}
+        with open(raw_path, "r", encoding="utf-8") as f:
+            raw_text = f.read()
+        return run_llm_pipeline(raw_text, raw_path, base_name, job_info["doc_output_dir"], llm_module, model_name, api_key)
+
+    # --- OCR result (started in prepare_file) ---
+    result = job_info["poller"].result()
+
+    # --- Collect OCR results + save raw text ---
+    # Entries reference the SDK's own strings and polygon lists rather than copying them
+    coords_data = [
+        {"page": page_num, "text": line.content, "boundingBox": line.polygon or []}
+        for page_num, page in enumerate(result.pages or [], start=1)
+        for line in (page.lines or [])
+    ]
+    # Written in one go, so an interrupted run leaves no truncated raw text for later runs to reuse
+    raw_text = "\n".join(entry["text"] for entry in coords_data)
+    write_output(raw_path, raw_text)
     logging.info(f"[Azure] Raw text saved: {raw_path}")
 
+    if not coords_data:
+        logging.warning(f"[Azure] No OCR text detected in {base_name}")
+
     # --- Save coordinates ---
     coords_path = os.path.join(job_info["doc_output_dir"], base_name + ".coords.json")
-    with open(coords_path, "w", encoding="utf-8") as f:
-        json.dump(coords_data, f, indent=2, ensure_ascii=False)
+    write_output(coords_path, orjson.dumps(coords_data, option=orjson.OPT_INDENT_2))
     logging.info(f"[Azure] Coordinates saved: {coords_path}")
 
-    # --- LLM client ---
-    client_llm = llm_module.get_client(api_key)
+    # --- LLM post-processing deferred (e.g. OpenAI Batch API) ---
+    if llm_module is None:
+        return {"status": "ocr_only", "base_name": base_name, "raw_path": raw_path}
 
-    # --- Correct text ---
-    corrected_obj, corrected_path = None, os.path.join(job_info["doc_output_dir"], base_name + ".corrected.txt")
-    try:
-        corrected_obj = llm_module.correct_text(raw_text, base_name, job_info["doc_output_dir"], client_llm, model_name)
-    except Exception as e:
-        logging.warning(f"[Azure] Correction failed for {base_name}: {e}")
-
-    text_for_entities = raw_text
-    if corrected_obj:
-        text_for_entities = corrected_obj.corrected_text
-        with open(corrected_path, "w", encoding="utf-8") as f:
-            f.write(text_for_entities)
-        logging.info(f"[Azure] Corrected text saved: {corrected_path}")
-
-    # --- Extract entities ---
-    try:
-        entities = llm_module.extract_entities(
-            text_for_entities, base_name, job_info["doc_output_dir"], client_llm, model_name
-        )
-        if entities:
-            logging.info(f"[Azure] Entities extracted for {base_name}")
-    except Exception as e:
-        logging.warning(f"[Azure] Entity extraction failed for {base_name}: {e}")
-        entities = {}
-        
-    # --- Explain entities ---
-    try:
-        explanations = llm_module.explain_entities(
-            entities, base_name, job_info["doc_output_dir"], client, model_name
-        )
-    except Exception as e:
-        logging.warning(f"[Provider] Entity explanation failed for {base_name}: {e}")
-
-    # --- Split into letters ---
-    combined, combined_path = None, None
-    try:
-        combined = llm_module.extract_page_and_split_letters(corrected_path, client_llm, model_name)
-        if combined:
-            combined_path = os.path.join(job_info["doc_output_dir"], base_name + ".combined_output.json")
-            with open(combined_path, "w", encoding="utf-8") as f:
-                json.dump(
-                    combined.model_dump() if hasattr(combined, "model_dump") else combined,
-                    f,
-                    indent=2,
-                    ensure_ascii=False,
-                )
-            logging.info(f"[Azure] Combined output saved: {combined_path}")
-    except Exception as e:
-        logging.warning(f"[Azure] Letter splitting failed for {base_name}: {e}")
-
-    return {
-        "status": "success",
-        "base_name": base_name,
-        "raw_path": raw_path,
-        "corrected_path": corrected_path if corrected_obj else None,
-        "entities": entities if entities else None,
-        "combined_path": combined_path if combined else None,
-    }
+    word_confidences = [word.confidence for page in (result.pages or []) for word in (page.words or [])]
+    confidence = sum(word_confidences) / len(word_confidences) if word_confidences else None
+
+    return run_llm_pipeline(
+        raw_text, raw_path, base_name, job_info["doc_output_dir"], llm_module, model_name, api_key, confidence=confidence
+    )
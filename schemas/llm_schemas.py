@@ -11,10 +11,23 @@ class EntitiesOutput(BaseModel):
     Theaters: List[str]
     Dates: List[str]
 
+class DocumentEntities(BaseModel):
+    doc_id: str
+    entities: EntitiesOutput
+
+class EntitiesBatchOutput(BaseModel):
+    documents: List[DocumentEntities]
+
 class CombinedOutput(BaseModel):
     page_number: Optional[int]
     letters: List[str]
 
+class CombinedPipelineOutput(BaseModel):
+    corrected_text: str
+    entities: EntitiesOutput
+    page_number: Optional[int]
+    letters: List[str]
+
 class EntityExplanations(BaseModel):
     People: Dict[str, str]
     Productions: Dict[str, str]
@@ -1,7 +1,10 @@
 import os
 import time
 import logging
-import json
+import orjson
+import threading
+from concurrent.futures import Future
+from utils.helpers import write_output
 
 def upload_file_to_s3(file_path, s3, bucket_name, s3_key):
     """
@@ -21,20 +24,25 @@ def upload_file_to_s3(file_path, s3, bucket_name, s3_key):
 def delete_all_files_in_bucket(s3, bucket_name):
     """
     Deletes all files in the specified S3 bucket.
+    Keys are listed page by page and removed with one delete_objects call per page (up to 1000 keys).
     Args:
         s3 (boto3.client): Boto3 S3 client.
         bucket_name (str): Name of the S3 bucket.
     """
     try:
-        response = s3.list_objects_v2(Bucket=bucket_name)
-        objects = response.get('Contents', [])
-        if not objects:
+        total = 0
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name):
+            objects = page.get('Contents', [])
+            if not objects:
+                continue
+            delete_keys = [{'Key': obj['Key']} for obj in objects]
+            result = s3.delete_objects(Bucket=bucket_name, Delete={'Objects': delete_keys, 'Quiet': True})
+            total += len(delete_keys) - len(result.get('Errors', []))
+
+        if not total:
             logging.info("No files to delete in S3 bucket.")
             return
-
-        delete_keys = [{'Key': obj['Key']} for obj in objects]
-        result = s3.delete_objects(Bucket=bucket_name, Delete={'Objects': delete_keys})
-        total = len(result.get('Deleted', []))
         logging.info(f"Deleted {total} files from S3 bucket '{bucket_name}'.")
 
     except Exception as e:
@@ -48,6 +56,9 @@ def extract_and_save_text_and_coords(job_id, base_name, doc_output_dir, textract
         base_name (str): Base name for the output files.
         doc_output_dir (str): Directory to save the output files.
         textract (boto3.client): Boto3 Textract client.
+    Returns:
+        tuple: (text, confidence) — the extracted text, as written to `<base_name>.raw.txt`,
+               and the mean word confidence between 0 and 1 (None if no words were found).
     """
     lines = []
     word_info = []
@@ -71,18 +82,20 @@ def extract_and_save_text_and_coords(job_id, base_name, doc_output_dir, textract
             break
 
     # Save plain text
-    with open(os.path.join(doc_output_dir, f"{base_name}.raw.txt"), 'w', encoding='utf-8') as f:
-        f.write("\n".join(lines))
+    raw_text = "\n".join(lines)
+    write_output(os.path.join(doc_output_dir, f"{base_name}.raw.txt"), raw_text)
 
     # Save word-level bounding box data
-    with open(os.path.join(doc_output_dir, f"{base_name}.coords.json"), 'w', encoding='utf-8') as jf:
-        json.dump(word_info, jf, indent=2)
+    write_output(os.path.join(doc_output_dir, f"{base_name}.coords.json"), orjson.dumps(word_info, option=orjson.OPT_INDENT_2))
 
     logging.info(f"Saved text and coordinates for {base_name}")
+    confidence = sum(word["confidence"] for word in word_info) / len(word_info) / 100 if word_info else None
+    return raw_text, confidence
 
 def start_textract_job(s3_pdf_key, textract, bucket_name):
     """
     Starts a Textract job for the specified PDF file in S3.
+    Throttling and transient errors are retried by the client's botocore retry config.
     Args:
         s3_pdf_key (str): S3 key for the PDF file.
         textract (boto3.client): Boto3 Textract client.
@@ -105,25 +118,127 @@ def start_textract_job(s3_pdf_key, textract, bucket_name):
         logging.error(f"Failed to start Textract job for {s3_pdf_key}: {e}")
         raise
 
-def wait_for_completion(job_id, textract, max_retries, delay):
+def wait_for_completion(job_id, textract, max_retries, delay, initial_delay=0.5, backoff=1.5):
     """
     Waits for the Textract job to complete.
+    Polls quickly at first, so short jobs are picked up soon after they finish, then
+    backs off to `delay` between polls for long ones.
     Args:
         job_id (str): Textract job ID.
         textract (boto3.client): Boto3 Textract client.
-        max_retries (int): Maximum number of retries before timing out.
-        delay (int): Delay between retries in seconds.
+        max_retries (int): Together with `delay`, bounds the wait at `max_retries * delay` seconds.
+        delay (int): Longest delay between polls in seconds.
+        initial_delay (float): First delay between polls in seconds.
+        backoff (float): Factor the delay grows by after each poll.
     Returns:
         bool: True if the job succeeded, False if it failed or timed out.
     """
-    for _ in range(max_retries):
-        result = textract.get_document_text_detection(JobId=job_id)
+    deadline = time.monotonic() + max_retries * delay
+    interval = min(initial_delay, delay)
+    while time.monotonic() < deadline:
+        result = textract.get_document_text_detection(JobId=job_id, MaxResults=1)
         status = result['JobStatus']
         if status == 'SUCCEEDED':
             return True
         elif status == 'FAILED':
             logging.error(f"Textract job failed: {result.get('StatusMessage')}")
             return False
-        time.sleep(delay)
+        time.sleep(interval)
+        interval = min(interval * backoff, delay)
     logging.error(f"Textract job {job_id} timed out.")
     return False
+
+
+class TextractJobMonitor:
+    """
+    Polls many Textract jobs from a single background thread, so waiting on a job
+    does not tie up a worker thread. Each job is polled on its own schedule, starting
+    at `initial_delay` and backing off to `delay`. Each watched job resolves a Future
+    with its final status: "SUCCEEDED", "FAILED" or "TIMED_OUT".
+    """
+
+    def __init__(self, textract, max_retries, delay, initial_delay=0.5, backoff=1.5):
+        """
+        Args:
+            textract (boto3.client): Boto3 Textract client.
+            max_retries (int): Together with `delay`, bounds each job's wait at `max_retries * delay` seconds.
+            delay (int): Longest delay between polls of a job in seconds.
+            initial_delay (float): First delay between polls of a job in seconds.
+            backoff (float): Factor a job's delay grows by after each poll.
+        """
+        self.textract = textract
+        self.max_retries = max_retries
+        self.delay = delay
+        self.initial_delay = min(initial_delay, delay)
+        self.backoff = backoff
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def watch(self, job_id):
+        """
+        Starts watching a Textract job.
+        Args:
+            job_id (str): Textract job ID.
+        Returns:
+            Future: Resolves to the final job status.
+        """
+        future = Future()
+        now = time.monotonic()
+        with self._lock:
+            self._jobs[job_id] = {
+                "future": future,
+                "interval": self.initial_delay,
+                "next_poll": now + self.initial_delay,
+                "deadline": now + self.max_retries * self.delay,
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="textract-monitor", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+                now = time.monotonic()
+                due = [(job_id, job) for job_id, job in self._jobs.items() if job["next_poll"] <= now]
+
+            for job_id, job in due:
+                try:
+                    result = self.textract.get_document_text_detection(JobId=job_id, MaxResults=1)
+                except Exception as e:
+                    logging.error(f"Failed to poll Textract job {job_id}: {e}")
+                    self._finish(job_id, exception=e)
+                    continue
+
+                status = result["JobStatus"]
+                if status == "SUCCEEDED":
+                    self._finish(job_id, status)
+                elif status == "FAILED":
+                    logging.error(f"Textract job failed: {result.get('StatusMessage')}")
+                    self._finish(job_id, status)
+                elif time.monotonic() >= job["deadline"]:
+                    logging.error(f"Textract job {job_id} timed out.")
+                    self._finish(job_id, "TIMED_OUT")
+                else:
+                    job["interval"] = min(job["interval"] * self.backoff, self.delay)
+                    job["next_poll"] = time.monotonic() + job["interval"]
+
+            # Sleep until the next job is due, or until a new job is watched
+            with self._lock:
+                next_poll = min((job["next_poll"] for job in self._jobs.values()), default=time.monotonic())
+                self._wakeup.clear()
+            self._wakeup.wait(max(0.0, next_poll - time.monotonic()))
+
+    def _finish(self, job_id, status=None, exception=None):
+        with self._lock:
+            future = self._jobs.pop(job_id)["future"]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(status)
@@ -0,0 +1,28 @@
+import os
+import threading
+
+# Default number of in-flight requests allowed per external service
+# (Ollama serves OLLAMA_NUM_PARALLEL requests at a time and queues the rest)
+DEFAULT_LIMITS = {"llm": 16, "ocr": 16, "ollama": int(os.getenv("OLLAMA_NUM_PARALLEL", 2))}
+
+_lock = threading.Lock()
+_semaphores = {}
+
+def service_slot(service):
+    """
+    Returns the semaphore that caps concurrent requests to an external service.
+    The limit is read from `<SERVICE>_MAX_CONCURRENCY` (e.g. LLM_MAX_CONCURRENCY) on first use,
+    so MAX_THREADS can grow without overrunning any one API.
+    Usage:
+        with service_slot("llm"):
+            ...
+    Args:
+        service (str): Service name, "llm", "ocr" or "ollama".
+    Returns:
+        threading.BoundedSemaphore: Semaphore shared by all threads.
+    """
+    with _lock:
+        if service not in _semaphores:
+            limit = int(os.getenv(f"{service.upper()}_MAX_CONCURRENCY", DEFAULT_LIMITS.get(service, 16)))
+            _semaphores[service] = threading.BoundedSemaphore(limit)
+        return _semaphores[service]
@@ -1,15 +1,43 @@
 import os
+import re
 import subprocess # Run ImageMagick CLI command
 import logging # Logging setup
 from datetime import datetime
 import time
 import shutil
+from PIL import Image, ImageSequence
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
 
 def split_into_batches(items, batch_size):
     """Splits a list into batches of size `batch_size`."""
     for i in range(0, len(items), batch_size):
         yield items[i:i + batch_size]
 
+def split_into_chunks(text, max_chars):
+    """
+    Splits text into chunks of at most `max_chars` characters, breaking at blank lines and,
+    inside paragraphs longer than `max_chars`, at single newlines.
+    Chunks keep their newlines, so joining them with "" gives back the original text.
+    A single line longer than `max_chars` becomes a chunk of its own.
+    """
+    pieces = []
+    for paragraph in re.findall(r"[\s\S]*?\n\s*\n|[\s\S]+", text):
+        if len(paragraph) > max_chars:
+            pieces.extend(re.findall(r"[^\n]*\n|[^\n]+", paragraph))
+        else:
+            pieces.append(paragraph)
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 def get_file_paths(filename, tmp_dir, input_dir, output_dir):
     """
     Generates file paths for the input filename, including:
@@ -28,17 +56,94 @@ def get_file_paths(filename, tmp_dir, input_dir, output_dir):
         "doc_output_dir": os.path.join(output_dir, base_name),
     }
 
+def is_up_to_date(path, source_path):
+    """
+    Checks whether an output file from a previous run can be reused.
+    Args:
+        path (str): Output file, e.g. the `.corrected.txt` of a document.
+        source_path (str): File the output was generated from, e.g. the `.raw.txt`.
+    Returns:
+        bool: True if both files exist and `path` is not older than `source_path`.
+              Always False when FORCE_REPROCESS=1.
+    """
+    if os.getenv("FORCE_REPROCESS", "0") == "1":
+        return False
+    if not os.path.exists(path) or not os.path.exists(source_path):
+        return False
+    return os.path.getmtime(path) >= os.path.getmtime(source_path)
+
+def write_output(path, data):
+    """
+    Writes an output file atomically: the data goes to a temporary file that then replaces `path`,
+    so an interrupted run never leaves a truncated file that a later run would reuse.
+    Args:
+        path (str): Output file path.
+        data (str | bytes): Contents; text is encoded as UTF-8.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+def read_page_number(text, default=None):
+    """
+    Reads a page number from the first line of a document's text.
+    Args:
+        text (str): Document text.
+        default (int | None): Returned when the first line is not a number.
+    Returns:
+        int | None: The page number, or `default`.
+    """
+    # Only the first line is sliced out; the rest of the text is not scanned or split
+    end = text.find("\n")
+    first_line = text if end < 0 else text[:end]
+    try:
+        return int(first_line.strip())
+    except ValueError:
+        return default
+
+def image_to_pdf(file_path, pdf_path):
+    """
+    Converts an image (every frame of a multi-page TIFF) to PDF in-process with Pillow.
+    Args:
+        file_path (str): Path to the input image file.
+        pdf_path (str): Path to save the output PDF file.
+    """
+    with Image.open(file_path) as im:
+        dpi = im.info.get("dpi", (72, 72))[0]
+        frames = [
+            frame.copy() if frame.mode in ("1", "L", "RGB") else frame.convert("RGB")
+            for frame in ImageSequence.Iterator(im)
+        ]
+    frames[0].save(pdf_path, "PDF", save_all=True, append_images=frames[1:], resolution=float(dpi), quality=95)
+
 def convert_to_pdf(file_path, pdf_path, image_magick_command="convert", filename=""):
     """
-    Converts an image file to PDF using ImageMagick.
+    Converts an image file to PDF.
+    Images are converted in-process with Pillow, avoiding an ImageMagick process per file;
+    other inputs, or images Pillow cannot read, go through ImageMagick.
     Args:
         file_path (str): Path to the input image file.
         pdf_path (str): Path to save the output PDF file.
         image_magick_command (str): Command to run ImageMagick. Default is "convert".
         filename (str): Name of the file being processed, for logging purposes.
     """
+    logging.info(f"Converting {filename} to PDF...")
+    if file_path.lower().endswith(IMAGE_EXTENSIONS):
+        try:
+            image_to_pdf(file_path, pdf_path)
+            return
+        except Exception as e:
+            logging.warning(f"Pillow could not convert {filename}, falling back to ImageMagick: {e}")
+
     try:
-        logging.info(f"Converting {filename} to PDF...")
         subprocess.run([image_magick_command, file_path, pdf_path], check=True)
     except subprocess.CalledProcessError as e:
         logging.error(f"ImageMagick failed to convert {file_path} to PDF: {e}")
@@ -107,24 +212,31 @@ import subprocess
 import logging
 import os
 
-def resize_image(file_path, output_path, image_magick_command="convert", filename="", max_dim="2000x2000>"):
+def resize_image_bytes(file_path, image_magick_command="convert", filename="", max_dim="2000x2000>"):
+    """
+    Resizes an image with ImageMagick and returns the result instead of writing it to disk.
+    The output is piped from ImageMagick's stdout in the input's own format.
+    Args:
+        file_path (str): Path to the input image file.
+        image_magick_command (str): Command to run ImageMagick. Default is "convert".
+        filename (str): Name of the file being processed, for logging purposes.
+        max_dim (str): ImageMagick geometry the image is shrunk to fit.
+    Returns:
+        bytes: The resized image.
+    """
+    ext = os.path.splitext(file_path)[1].lstrip(".").lower()
+    logging.info(f"Resizing {filename or os.path.basename(file_path)} to max {max_dim}...")
+
+    cmd = [
+        image_magick_command,
+        file_path,
+        "-resize", max_dim,
+        "-strip",       # remove metadata
+        "-quality", "85",  # for JPG/PNG compression
+        f"{ext}:-"      # write to stdout
+    ]
     try:
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        logging.info(f"Resizing {filename or os.path.basename(file_path)} to max {max_dim}...")
-
-        cmd = [
-            image_magick_command,
-            file_path,
-            "-resize", max_dim,
-            "-strip",       # remove metadata
-            "-quality", "85",  # for JPG/PNG compression
-            output_path
-        ]
-        subprocess.run(cmd, check=True)
-
-        logging.info(f"Resized image saved: {output_path}")
-        return output_path
-
+        return subprocess.run(cmd, check=True, capture_output=True).stdout
     except subprocess.CalledProcessError as e:
-        logging.error(f"ImageMagick failed to resize {file_path}: {e}")
+        logging.error(f"ImageMagick failed to resize {file_path}: {e.stderr.decode(errors='replace').strip()}")
         raise
@@ -0,0 +1,164 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import orjson
+from concurrent.futures import Future
+from functools import wraps, lru_cache
+from llms._prompts import PROMPTS
+
+_lock = threading.Lock()
+_connection = None
+# Futures of requests currently being sent, by cache key
+_in_flight = {}
+
+def get_connection():
+    """
+    Opens the SQLite cache database named by LLM_CACHE_PATH, creating the table on first use.
+    Returns:
+        sqlite3.Connection | None: Shared connection, or None when caching is disabled.
+    """
+    global _connection
+    cache_path = os.getenv("LLM_CACHE_PATH")
+    if not cache_path:
+        return None
+
+    with _lock:
+        if _connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            _connection = sqlite3.connect(cache_path, check_same_thread=False)
+            _connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key BLOB PRIMARY KEY, value TEXT, ts INTEGER)"
+            )
+            _connection.commit()
+            logging.info(f"LLM response cache enabled: {cache_path}")
+    return _connection
+
+def make_key(*parts):
+    """Hashes the given strings into a cache key."""
+    digest = hashlib.blake2b(digest_size=32)
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.digest()
+
+@lru_cache(maxsize=None)
+def schema_text(model):
+    """Returns a pydantic model's JSON schema as canonical text."""
+    return orjson.dumps(model.model_json_schema(), option=orjson.OPT_SORT_KEYS).decode()
+
+def request_key(module, model_name, prompt_name, text, kwargs):
+    """
+    Builds the cache key for a completion request.
+    The prompt's current wording and the request options are part of the key, so editing
+    prompts.json or changing e.g. the response schema does not return stale results.
+    """
+    options = []
+    for name, value in sorted(kwargs.items()):
+        if hasattr(value, "model_json_schema"):
+            value = schema_text(value)
+        options.append(f"{name}={value!r}")
+    return make_key(module, model_name, prompt_name, PROMPTS.get(prompt_name, ""), *options, text)
+
+def cached(fn):
+    """
+    Caches the string result of an LLM completion function in SQLite.
+    The wrapped function must have the signature `fn(client, model_name, prompt_name, text, **kwargs)`;
+    results are keyed by the provider module, model name, prompt, request options and text.
+    Identical requests made while one is already in flight wait for its result instead of
+    being sent again, whether or not the SQLite cache is enabled (via LLM_CACHE_PATH).
+    Callers that find a result unusable drop it with `fn.invalidate(...)`, called with the
+    same arguments. `fn.lookup(...)` reads a cached result without sending the request, and
+    `fn.store(result, ...)` saves one obtained some other way, e.g. from a batched request.
+    `fn.validated(schema, ...)` sends the request and parses the result into a pydantic model,
+    dropping it from the cache if it does not validate.
+    """
+    def read(key):
+        conn = get_connection()
+        if conn is None:
+            return None
+        with _lock:
+            row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def write(key, result):
+        conn = get_connection()
+        if not result or conn is None:
+            return
+        with _lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, ts) VALUES (?, ?, ?)",
+                (key, result, int(time.time())),
+            )
+            conn.commit()
+
+    @wraps(fn)
+    def wrapper(client, model_name, prompt_name, text, **kwargs):
+        key = request_key(fn.__module__, model_name, prompt_name, text, kwargs)
+
+        result = read(key)
+        if result is not None:
+            logging.info(f"[Cache] Hit for {prompt_name} ({model_name})")
+            return result
+
+        with _lock:
+            pending = _in_flight.get(key)
+            owner = pending is None
+            if owner:
+                pending = _in_flight[key] = Future()
+        if not owner:
+            logging.info(f"[Cache] Waiting on identical in-flight {prompt_name} request ({model_name})")
+            return pending.result()
+
+        try:
+            result = fn(client, model_name, prompt_name, text, **kwargs)
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with _lock:
+                _in_flight.pop(key, None)
+        pending.set_result(result)
+
+        write(key, result)
+        return result
+
+    def lookup(client, model_name, prompt_name, text, **kwargs):
+        """Returns the cached result of a request, or None, without sending it."""
+        return read(request_key(fn.__module__, model_name, prompt_name, text, kwargs))
+
+    def store(result, client, model_name, prompt_name, text, **kwargs):
+        """Caches `result` as the result of the given request."""
+        write(request_key(fn.__module__, model_name, prompt_name, text, kwargs), result)
+
+    def invalidate(client, model_name, prompt_name, text, **kwargs):
+        """Drops a cached result, e.g. one that turned out not to parse, so the next call re-asks the model."""
+        conn = get_connection()
+        if conn is None:
+            return
+        key = request_key(fn.__module__, model_name, prompt_name, text, kwargs)
+        with _lock:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            conn.commit()
+
+    def validated(schema, client, model_name, prompt_name, text, **kwargs):
+        """
+        Runs the request and parses its result with `schema.model_validate_json`.
+        A result that fails validation (pydantic's ValidationError is a ValueError) is removed
+        from the cache before the error is re-raised, so it is not replayed on later runs.
+        """
+        result = wrapper(client, model_name, prompt_name, text, **kwargs)
+        try:
+            return schema.model_validate_json(result)
+        except ValueError:
+            logging.warning(f"[Cache] Dropping {prompt_name} reply that does not match {schema.__name__} ({model_name})")
+            invalidate(client, model_name, prompt_name, text, **kwargs)
+            raise
+
+    wrapper.invalidate = invalidate
+    wrapper.validated = validated
+    wrapper.lookup = lookup
+    wrapper.store = store
+    return wrapper
@@ -0,0 +1,156 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.helpers import is_up_to_date, write_output
+from utils.text_quality import looks_clean
+from schemas.llm_schemas import CorrectedText, EntitiesOutput, CombinedOutput
+
+# Correct, extract entities and split letters with one LLM call when the provider supports it
+SINGLE_LLM_CALL = os.getenv("SINGLE_LLM_CALL", "0") == "1"
+# Documents shorter than this many characters are not sent for correction (0 corrects all)
+CORRECTION_MIN_CHARS = int(os.getenv("CORRECTION_MIN_CHARS", 0))
+# Documents whose mean OCR word confidence (0-1) exceeds this are not sent for correction
+CORRECTION_MAX_CONFIDENCE = float(os.getenv("CORRECTION_MAX_CONFIDENCE", 1.0))
+# Skip correction for text with no typical OCR artifacts
+CORRECTION_SKIP_CLEAN = os.getenv("CORRECTION_SKIP_CLEAN", "0") == "1"
+
+def needs_correction(raw_text, confidence):
+    """
+    Decides whether OCR text is worth an LLM correction call.
+    Args:
+        raw_text (str): OCR text of the document.
+        confidence (float | None): Mean OCR word confidence between 0 and 1, if known.
+    Returns:
+        bool: False for very short text, text the OCR engine is already confident about,
+              or, with CORRECTION_SKIP_CLEAN=1, text that looks clean.
+    """
+    if len(raw_text) < CORRECTION_MIN_CHARS:
+        return False
+    if CORRECTION_SKIP_CLEAN and looks_clean(raw_text):
+        return False
+    return confidence is None or confidence <= CORRECTION_MAX_CONFIDENCE
+
+def run_llm_pipeline(raw_text, raw_path, base_name, doc_output_dir, llm_module, model_name, api_key, confidence=None):
+    """
+    Runs LLM post-processing on a document's OCR text: correction, entity extraction,
+    letter splitting and entity explanations, shared by every OCR provider.
+    Outputs newer than the files they derive from are reused instead of regenerated.
+    Args:
+        raw_text (str): OCR text of the document.
+        raw_path (str): Path of the saved `.raw.txt`.
+        base_name (str): Base name of the document.
+        doc_output_dir (str): Directory for the document's output files.
+        llm_module (module): LLM provider module from `llms`.
+        model_name (str): Model to use.
+        api_key (str | None): API key for the LLM provider.
+        confidence (float | None): Mean OCR word confidence between 0 and 1, if the provider reports one.
+    Returns:
+        dict: Result with status "success" and the paths of the files written.
+    """
+    # --- LLM client ---
+    client = llm_module.get_client(api_key)
+    corrected_path = os.path.join(doc_output_dir, base_name + ".corrected.txt")
+    combined_path = os.path.join(doc_output_dir, base_name + ".combined_output.json")
+    entities_path = os.path.join(doc_output_dir, base_name + ".entities.json")
+
+    # --- Correct, extract entities and split letters in one call ---
+    corrected_obj, entities, combined = None, {}, None
+    # Only when the corrected text is missing or stale; otherwise the steps below reuse what is current
+    if SINGLE_LLM_CALL and hasattr(llm_module, "process_document") and not is_up_to_date(corrected_path, raw_path):
+        try:
+            corrected_obj, entities, combined = llm_module.process_document(
+                raw_text, base_name, doc_output_dir, client, model_name
+            )
+            logging.info(f"[LLM] Processed {base_name} in a single LLM call")
+        except Exception as e:
+            logging.warning(f"[LLM] Single-call processing failed for {base_name}, using separate steps: {e}")
+
+    if combined is None:
+        # --- Correct text ---
+        if is_up_to_date(corrected_path, raw_path):
+            with open(corrected_path, "r", encoding="utf-8") as f:
+                corrected_obj = CorrectedText.model_construct(corrected_text=f.read())
+            logging.info(f"[LLM] Reusing corrected text for {base_name}")
+        elif not needs_correction(raw_text, confidence):
+            # Later steps read the corrected file, so the OCR text stands in for it
+            write_output(corrected_path, raw_text)
+            corrected_obj = CorrectedText.model_construct(corrected_text=raw_text)
+            logging.info(f"[LLM] Skipping correction for {base_name} (confidence {confidence}, {len(raw_text)} chars)")
+        else:
+            try:
+                corrected_obj = llm_module.correct_text(raw_text, base_name, doc_output_dir, client, model_name)
+            except Exception as e:
+                logging.warning(f"[LLM] Correction failed for {base_name}: {e}")
+            # An empty reply for non-empty text is a failed call, not a correction worth keeping
+            if corrected_obj and not corrected_obj.corrected_text.strip() and raw_text.strip():
+                logging.warning(f"[LLM] Correction returned no text for {base_name}")
+                if os.path.exists(corrected_path):
+                    os.remove(corrected_path)
+                corrected_obj = None
+
+        text_for_entities = raw_text
+        if corrected_obj:
+            text_for_entities = corrected_obj.corrected_text
+
+        # --- Extract entities ---
+        def get_entities():
+            if is_up_to_date(entities_path, corrected_path):
+                with open(entities_path, "rb") as f:
+                    logging.info(f"[LLM] Reusing entities for {base_name}")
+                    return EntitiesOutput.model_validate_json(f.read())
+            try:
+                entities = llm_module.extract_entities(
+                    text_for_entities, base_name, doc_output_dir, client, model_name
+                )
+                if entities:
+                    logging.info(f"[LLM] Entities extracted for {base_name}")
+                return entities
+            except Exception as e:
+                logging.warning(f"[LLM] Entity extraction failed for {base_name}: {e}")
+                return {}
+
+        # --- Split into letters ---
+        def get_combined():
+            if is_up_to_date(combined_path, corrected_path):
+                with open(combined_path, "rb") as f:
+                    logging.info(f"[LLM] Reusing combined output for {base_name}")
+                    return CombinedOutput.model_validate_json(f.read())
+            # The combined output marks a document as done, so it is only written from corrected text
+            if not corrected_obj:
+                logging.warning(f"[LLM] Skipping letter splitting for {base_name}: no corrected text")
+                return None
+            try:
+                # The corrected text is passed along, so the file just written is not read back
+                return llm_module.extract_page_and_split_letters(
+                    corrected_path, client, model_name, text=corrected_obj.corrected_text
+                )
+            except Exception as e:
+                logging.warning(f"[LLM] Letter splitting failed for {base_name}: {e}")
+                return None
+
+        # Both only need the corrected text, so they run side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            entities_future = executor.submit(get_entities)
+            combined_future = executor.submit(get_combined)
+            entities, combined = entities_future.result(), combined_future.result()
+
+    # --- Explain entities ---
+    explained_path = os.path.join(doc_output_dir, base_name + ".entities_explained.json")
+    if entities and is_up_to_date(explained_path, entities_path):
+        logging.info(f"[LLM] Reusing entity explanations for {base_name}")
+    else:
+        try:
+            llm_module.explain_entities(
+                entities, base_name, doc_output_dir, client, model_name
+            )
+        except Exception as e:
+            logging.warning(f"[LLM] Entity explanation failed for {base_name}: {e}")
+
+    return {
+        "status": "success",
+        "base_name": base_name,
+        "raw_path": raw_path,
+        "corrected_path": corrected_path if corrected_obj else None,
+        "entities": entities if entities else None,
+        "combined_path": combined_path if combined else None,
+    }
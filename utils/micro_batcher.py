@@ -0,0 +1,91 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+class MicroBatcher:
+    """
+    Groups items submitted from many threads into batched calls.
+    A batch is sent once it holds `max_items` items, once adding an item would take it past
+    `max_size`, or `max_wait` seconds after its first item arrived, whichever comes first.
+    Usage:
+        batcher = MicroBatcher(handle_batch, max_items=8, max_wait=2.0)
+        result = batcher.submit(item).result()
+    Args:
+        handler (callable): Takes a list of items and returns a list of results in the same order;
+            items left without a result fail with RuntimeError.
+        max_items (int): Most items per batch.
+        max_wait (float): Seconds a partial batch waits for more items.
+        max_size (int | None): Upper bound on the summed `size` of a batch's items.
+        size (callable): Size of one item, e.g. its length in characters.
+    """
+
+    def __init__(self, handler, max_items, max_wait, max_size=None, size=len):
+        self._handler = handler
+        self._max_items = max_items
+        self._max_wait = max_wait
+        self._max_size = max_size
+        self._size = size
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_size = 0
+        self._generation = 0
+        self._timer = None
+
+    def submit(self, item):
+        """Queues an item; returns a Future that resolves to its result."""
+        future = Future()
+        item_size = self._size(item) if self._max_size else 0
+        ready = []
+        with self._lock:
+            if self._pending and self._max_size and self._pending_size + item_size > self._max_size:
+                ready.append(self._take())
+            self._pending.append((item, future))
+            self._pending_size += item_size
+            if len(self._pending) >= self._max_items:
+                ready.append(self._take())
+            elif self._timer is None:
+                self._timer = threading.Timer(self._max_wait, self._flush, args=(self._generation,))
+                self._timer.daemon = True
+                self._timer.start()
+
+        # The thread that completes a batch sends it; it would be waiting on the result anyway
+        for batch in ready:
+            self._run(batch)
+        return future
+
+    def _take(self):
+        """Removes and returns the pending batch. Must be called with the lock held."""
+        batch = self._pending
+        self._pending, self._pending_size = [], 0
+        self._generation += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self, generation):
+        """Sends a partial batch once its wait has expired, unless it was already sent."""
+        with self._lock:
+            if generation != self._generation or not self._pending:
+                return
+            batch = self._take()
+        self._run(batch)
+
+    def _run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = list(self._handler(items))
+        except Exception as e:
+            logging.warning(f"[Batcher] Batch of {len(items)} items failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+        # Items the handler returned no result for would otherwise leave their callers waiting forever
+        if len(results) < len(batch):
+            error = RuntimeError(f"Batch handler returned {len(results)} results for {len(batch)} items")
+            logging.warning(f"[Batcher] {error}")
+            for _, future in batch[len(results):]:
+                future.set_exception(error)
@@ -0,0 +1,74 @@
+import os
+import time
+import threading
+
+# Requests and tokens per minute allowed per (provider, model); 0 disables the limit
+LLM_RPM = int(os.getenv("LLM_RPM", 0))
+LLM_TPM = int(os.getenv("LLM_TPM", 0))
+
+# Rough characters per token for English text, used instead of a tokenizer
+CHARS_PER_TOKEN = 4
+
+_lock = threading.Lock()
+_buckets = {}
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: tokens refill continuously at `rate_per_sec` up to `capacity`,
+    and `acquire` blocks until enough are available.
+    """
+
+    def __init__(self, rate_per_sec, capacity):
+        self.rate_per_sec = rate_per_sec
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Takes `tokens` from the bucket, waiting for them to refill if needed.
+        Requests larger than the bucket are capped at its capacity so they can still proceed.
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_sec)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate_per_sec
+            time.sleep(wait)
+
+def estimate_tokens(*texts):
+    """Estimates the token count of the given texts from their length."""
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN + 1
+
+def rate_limit(provider, model_name, *texts):
+    """
+    Paces an LLM request against the per-minute request (LLM_RPM) and token (LLM_TPM) limits
+    of its provider and model. Blocks until the request may be sent; does nothing when no
+    limit is set.
+    Args:
+        provider (str): Provider name, e.g. the LLM module's name.
+        model_name (str): Model the request is sent to.
+        *texts (str): Prompt and input text, used to estimate the request's tokens.
+    """
+    if not LLM_RPM and not LLM_TPM:
+        return
+
+    with _lock:
+        key = (provider, model_name)
+        if key not in _buckets:
+            _buckets[key] = (
+                TokenBucket(LLM_RPM / 60, LLM_RPM) if LLM_RPM else None,
+                TokenBucket(LLM_TPM / 60, LLM_TPM) if LLM_TPM else None,
+            )
+        requests, tokens = _buckets[key]
+
+    if requests:
+        requests.acquire(1)
+    if tokens:
+        tokens.acquire(estimate_tokens(*texts))
@@ -0,0 +1,85 @@
+import os
+import time
+import random
+import logging
+from functools import wraps
+
+# Attempts per call, including the first, and the cap on a single backoff in seconds
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+RETRY_MAX_WAIT = float(os.getenv("RETRY_MAX_WAIT", 30))
+
+# HTTP statuses below 500 worth retrying: timeouts, conflicts and throttling; every 5xx is retried
+RETRYABLE_STATUSES = {408, 409, 429}
+
+# AWS error codes returned for throttling or transient service faults
+RETRYABLE_AWS_CODES = {
+    "ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException",
+    "RequestLimitExceeded", "TooManyRequestsException", "InternalServerError", "ServiceUnavailable",
+}
+
+# Connection-level errors raised by the OpenAI, Anthropic, Azure and botocore SDKs
+RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "ServiceRequestError", "ServiceResponseError",
+    "EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError",
+}
+
+def is_transient(error):
+    """
+    Decides whether an SDK error is worth retrying.
+    Errors are classified by their attributes rather than imported types, so only the
+    SDKs of the configured providers need to be installed.
+    Args:
+        error (Exception): Raised exception.
+    Returns:
+        bool: True for throttling, server-side and connection errors.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+
+    # botocore ClientError
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code") in RETRYABLE_AWS_CODES
+
+    # OpenAI/Anthropic APIStatusError, Azure HttpResponseError; includes Anthropic's 529 "overloaded"
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and (status >= 500 or status in RETRYABLE_STATUSES)
+
+def retry_after(error):
+    """Returns the server-requested delay in seconds from a Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def resilient(fn):
+    """
+    Retries a function on transient API errors with jittered exponential backoff.
+    A Retry-After header on the error takes precedence over the computed delay.
+    Non-transient errors and the last failed attempt are re-raised unchanged.
+    Usage:
+        @resilient
+        def call_api(...):
+            ...
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == RETRY_MAX_ATTEMPTS or not is_transient(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(RETRY_MAX_WAIT, 2 ** attempt))
+                delay = min(delay, RETRY_MAX_WAIT)
+                logging.warning(
+                    f"[Retry] {fn.__name__} failed ({type(e).__name__}), attempt {attempt}/{RETRY_MAX_ATTEMPTS}; retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+    return wrapper
@@ -0,0 +1,56 @@
+import re
+
+# Share of letters among non-space characters expected of clean prose
+CLEAN_MIN_ALPHA_RATIO = 0.85
+# Share of words that must be common English words; clean prose is mostly function words
+CLEAN_MIN_KNOWN_RATIO = 0.4
+
+# Control characters, replacement characters, digits inside words ("th1s"), a lone "l" read for "I",
+# double spaces, "q" followed by a letter other than "u" ("qnick")
+OCR_ARTIFACT_PATTERN = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffd]|\b[^\W\d_]+\d+[^\W\d_]+\b|\bl\b|  |q(?=[^\W\d_u])")
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+
+# Letter groups OCR engines commonly read in place of a single letter
+CONFUSIONS = (("rn", "m"), ("vv", "w"), ("cl", "d"), ("li", "h"), ("ii", "u"))
+
+# Frequent English words, used to tell prose from garbled OCR output without a full dictionary
+COMMON_WORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could dear did do does doing down during each few for from further had has have
+having he her here hers herself him himself his how i if in into is it its itself just let me more most
+my myself no nor not now of off on once only or other our ours ourselves out over own same she should
+so some such than that the their theirs them themselves then there these they this those through to too
+under until up upon very was we were what when where which while who whom why will with would you your
+yours yourself yourselves one two three first last new old good great little much many well may might
+must shall made make know see come go get give take said say says think like time year years day days
+week month letter letters write wrote written thank thanks sir madam mr mrs miss friend yours truly
+sincerely respectfully faithfully kind kindly regards received hope glad sorry please enclosed send
+sent company theatre theater play plays show season week night part stage town city house home work
+""".split())
+
+def looks_garbled(word):
+    """Returns True for a word that becomes a common word once an OCR letter confusion is undone."""
+    if word in COMMON_WORDS:
+        return False
+    return any(wrong in word and word.replace(wrong, right) in COMMON_WORDS for wrong, right in CONFUSIONS)
+
+def looks_clean(text):
+    """
+    Cheap check for OCR text that is unlikely to need correction.
+    Args:
+        text (str): OCR text of the document.
+    Returns:
+        bool: True if the text has none of the usual OCR artifacts, no words that read as
+              common words with letter confusions undone ("rn" for "m", "vv" for "w", ...),
+              is mostly letters, and has enough common English words to read as prose.
+    """
+    if not text or OCR_ARTIFACT_PATTERN.search(text):
+        return False
+    non_space = len(text) - sum(map(str.isspace, text))
+    if not non_space or sum(map(str.isalpha, text)) / non_space <= CLEAN_MIN_ALPHA_RATIO:
+        return False
+
+    words = [word.lower() for word in WORD_PATTERN.findall(text)]
+    if not words or any(looks_garbled(word) for word in words):
+        return False
+    return sum(word in COMMON_WORDS for word in words) / len(words) >= CLEAN_MIN_KNOWN_RATIO